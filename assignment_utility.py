@@ -0,0 +1,142 @@
+'''
+The assignment record shared by every source (GFU sites, Canvas, Trello)
+and the main driver.
+'''
+
+from datetime import datetime, timezone
+from dedup_utility import normalize_key
+import sys
+import markdown_utility
+
+
+def parse_due(due):
+    '''
+    Parses a due date in any of the ISO formats the sources use
+    (e.g. "2020-10-05T23:59:00", "2020-10-05T06:59:59Z",
+    "2020-10-05T06:59:59.000").
+
+    params:
+    - due: the ISO date string
+
+    returns:
+    - a naive datetime; dates with a time zone are converted to UTC
+    '''
+
+    if due.endswith('Z'):
+        due = due[:-1] + '+00:00'
+    result = datetime.fromisoformat(due)
+    if result.tzinfo:
+        result = result.astimezone(timezone.utc).replace(tzinfo=None)
+    return result
+
+
+class Assignment:
+    '''
+    A single school assignment.
+
+    The class code is interned and the dedup key is computed once when the
+    assignment is made; the due date is parsed when it is read. The
+    Markdown description is only rendered from the raw HTML when it is
+    read (through the shared markdown_utility cache), since most
+    assignments are already on Trello and never need one.
+    '''
+
+    __slots__ = ('class_name', 'title', 'due', 'key', 'html', 'url',
+        '_description')
+
+    def __init__(self, class_name, title, due, description=None, html=None, url=None):
+        '''
+        params:
+        - class_name: the class code, e.g. "CSIS 420"
+        - title: the assignment title
+        - due: the due date as an ISO string (sent to Trello as is)
+        - description: the Markdown description, if already known
+        - html: the raw HTML the description is rendered from otherwise
+        - url: for Canvas assignments, the link to the assignment
+          ('' if it has none); the rendered description is stripped
+          and starts with the link. None for other sources
+        '''
+
+        self.class_name = sys.intern(class_name)
+        self.title = title
+        self.due = due
+        class_key, title_key = normalize_key(class_name, title)
+        self.key = (sys.intern(class_key), title_key)
+        self.html = html
+        self.url = url
+        self._description = description
+
+    @property
+    def due_at(self):
+        '''
+        The due date as a naive UTC datetime (see parse_due).
+        '''
+
+        return parse_due(self.due)
+
+    @property
+    def description(self):
+        '''
+        The Markdown description: the one given, or else rendered from the
+        HTML each time (markdown_utility caches the conversions).
+        '''
+
+        if self._description is not None:
+            return self._description
+
+        description = markdown_utility.to_markdown(self.html) if self.html else ''
+
+        if self.url is not None:
+            description = description.strip()
+            if self.url:
+                description = '{}\n\n{}'.format(self.url, description)
+
+        return description
+
+    def to_dict(self, render=False):
+        '''
+        Converts the assignment to a JSON-friendly dict.
+
+        params:
+        - render: include the rendered description instead of the raw HTML
+
+        returns:
+        - a dict with the keys class, due, title, and either description
+          or html/url (whichever the assignment has, unless render is set)
+        '''
+
+        result = {'class': self.class_name, 'due': self.due, 'title': self.title}
+        if render or self._description is not None:
+            result['description'] = self.description
+        else:
+            result['html'] = self.html
+            result['url'] = self.url
+        return result
+
+    @classmethod
+    def from_dict(cls, data):
+        '''
+        Makes an assignment from a dict made by to_dict.
+        '''
+
+        return cls(data['class'], data['title'], data['due'],
+            description=data.get('description'),
+            html=data.get('html'), url=data.get('url'))
+
+    def _fields(self):
+        # the source fields; a rendered description is never kept, so
+        # this only holds one that was given
+        return (self.key, self.class_name, self.title, self.due,
+            self.html, self.url, self._description)
+
+    def __eq__(self, other):
+        if not isinstance(other, Assignment):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return 'Assignment({!r}, {!r}, {!r})'.format(
+            self.class_name, self.title, self.due)
@@ -0,0 +1,628 @@
+'''
+Asyncio driver that checks every source and adds new assignments to Trello
+on a single event loop.
+
+The course sites, Canvas, and Trello are fetched concurrently as coroutines
+instead of threads, over one aiohttp session that keeps a bounded number of
+connections open per host. A source that doesn't finish within its timeout
+is cancelled along with every request it still has open. Like
+main.py --yes, new assignments are added without asking (or only listed
+with --dry-run).
+
+The synchronous utilities are left as they are, since they also run in
+thread pools, worker processes, and the daemon. The coroutines here share
+their request building, response handling, parsing, caching, label,
+store, and report code, so only the I/O differs. The local copy of the
+Trello cards is synced here too, but --incremental Canvas syncs are run
+by the synchronous code in a worker thread, so they can't be cut short
+by the timeout.
+
+Usage:
+
+    python async_engine.py [--dry-run[=path]] [--report[=path]]
+        [--timeout=S] [--connections=N] [--paginate] [--incremental]
+        [--full-sync] [--no-cache] [--lxml] [--create-labels]
+'''
+
+from datetime import datetime as dt
+from urllib.parse import urlsplit
+from dedup_utility import AssignmentIndex
+from state_utility import AssignmentStore
+from main import diff_new_assignments, json_to_stdout, summarize, write_json
+import asyncio, contextlib, json, sys, time
+import aiohttp, requests
+import config_utility, http_utility, markdown_utility
+import gfu_utility as cs_scraper
+import trello_utility as trello
+import canvas_utility as canvas
+
+
+# default seconds a whole source may take before it is cancelled
+SOURCE_TIMEOUT = 120
+
+# failed idempotent requests are retried on these statuses, like http_utility
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class AsyncResponse:
+    '''
+    A response read in full, with the parts of requests.Response
+    the utilities use.
+    '''
+
+    __slots__ = ('url', 'status_code', 'headers', 'content', 'encoding')
+
+    def __init__(self, url, status_code, headers, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def raise_for_status(self):
+        '''
+        raises:
+        - requests.HTTPError for a 4xx or 5xx status, like requests does
+        '''
+
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} Error for url: {}'.format(
+                self.status_code, self.url))
+
+
+class AsyncHttpClient:
+    '''
+    aiohttp session with a bounded semaphore per host, optional per-host
+    rate limits, a timeout on every request, and retry/backoff for failed
+    idempotent requests. Use it as an async context manager.
+    '''
+
+    def __init__(self, connections=http_utility.POOL_MAXSIZE,
+        timeout=http_utility.TIMEOUT, retries=http_utility.RETRIES,
+        backoff=http_utility.BACKOFF):
+        '''
+        params:
+        - connections: the most requests sent to a single host at once
+        - timeout: default seconds to wait for a server
+        - retries: times a failed GET/HEAD/PUT/DELETE is retried
+        - backoff: backoff factor between retries, in seconds
+        '''
+
+        self.connections = connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self._semaphores = {}
+        self._limits = {}
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0,
+                limit_per_host=self.connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def limit(self, host, rate, capacity=None):
+        '''
+        Rate limits every request to a host (see HttpClient.limit).
+        '''
+
+        self._limits[host] = http_utility.TokenBucket(rate, capacity or rate)
+
+    async def request(self, method, url, timeout=None, retry=True, **kwargs):
+        '''
+        Sends a request once the host has a free connection.
+
+        params:
+        - method: the HTTP method
+        - url: the URL to request
+        - timeout: seconds to wait for this request; defaults to the
+          client's timeout
+        - retry: if False, a failed request isn't retried, so its timeout
+          caps how long it takes
+        - kwargs: passed on to aiohttp (headers, params, json)
+
+        returns:
+        - an AsyncResponse
+
+        raises:
+        - asyncio.TimeoutError if the server took longer than the timeout
+        - aiohttp.ClientError if the request couldn't be sent
+        '''
+
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+        host = urlsplit(url).hostname
+        semaphore = self._semaphores.setdefault(host,
+            asyncio.BoundedSemaphore(self.connections))
+        limiter = self._limits.get(host)
+
+        retries = self.retries if retry and method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            retry = attempt < retries
+            if limiter:
+                await limiter.take_async()
+
+            try:
+                async with semaphore:
+                    async with self.session.request(method, url, **kwargs) as r:
+                        response = AsyncResponse(url, r.status, r.headers,
+                            await r.read(), r.charset)
+            except aiohttp.ClientConnectionError:
+                if not retry:
+                    raise
+            else:
+                if not (retry and response.status_code in RETRY_STATUSES):
+                    return response
+
+            # the semaphore is free while waiting to try again
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+
+async def get_sites_assignments(client, sites, timeout=cs_scraper.TIMEOUT,
+    use_cache=None, parser=None, skip=None):
+    '''
+    Gets the assignments of a list of course sites like
+    gfu_utility.get_sites_assignments, downloading every distinct URL at
+    once and parsing each page in a worker thread as it arrives.
+
+    params:
+    - client: the AsyncHttpClient to send requests through
+    - sites, timeout, use_cache, parser, skip:
+      see gfu_utility.get_sites_assignments
+
+    returns:
+    - a list with a list of Assignments for each site, in the same order
+    '''
+
+    cache, parser = cs_scraper.site_options(use_cache, parser)
+    urls = cs_scraper.group_sites(sites)
+
+    async def fetch(url, site_info, class_names):
+        print('Fetching assignments for {} from {}'.format(class_names[0], url))
+
+        headers = site_info['headers']
+        if cache:
+            headers = cache.conditional_headers(url, headers)
+        response = await client.request('GET', url, headers=headers,
+            timeout=timeout, retry=False)
+        html, entry = cache.resolve(url, response) if cache \
+            else (response.text, None)
+
+        # page unchanged since last run
+        if html is None:
+            return dict(cs_scraper.cached_assignments(entry, class_names))
+
+        # parsing would hold up every other request on the loop
+        parsed = {}
+        for class_name in class_names:
+            parsed[class_name] = await asyncio.to_thread(
+                cs_scraper.parse_site_assignments, class_name, html,
+                None, parser, skip)
+
+        cs_scraper.cache_parsed(cache, url, entry, parsed[class_names[0]])
+        return parsed
+
+    # a site that fails or times out only loses that class's assignments
+    results = await asyncio.gather(
+        *(fetch(url, site_info, class_names)
+            for (url, (site_info, class_names)) in urls.items()),
+        return_exceptions=True)
+
+    parsed = {}
+    for ((url, (_, class_names)), result) in zip(urls.items(), results):
+        if isinstance(result, BaseException):
+            print(f'Error parsing {class_names[0]}')
+            continue
+        for (class_name, assignments) in result.items():
+            parsed[(class_name, url)] = assignments
+
+    if cache:
+        cache.save()
+
+    return [parsed.get((class_name, site_info['url']), [])
+        for (class_name, site_info) in sites]
+
+
+async def _send_query(client, query, variables=None, token=None):
+    '''
+    Sends a GraphQL query to Canvas like canvas_utility._send_query.
+
+    returns:
+    - the JSON data of the response, or None if an error occurred
+    '''
+
+    response = await client.request('POST', canvas.ENDPOINT,
+        **canvas.query_request(query, variables, token))
+    return canvas.query_data(response)
+
+
+async def get_canvas_assignments(client, included_accounts=None, paginate=False,
+    page_size=canvas.PAGE_SIZE, skip=None, token=None, incremental=False):
+    '''
+    Gets all school assignments for included accounts like
+    canvas_utility.get_assignments. When paginating, the active courses
+    are paged through at the same time.
+
+    params:
+    - client: the AsyncHttpClient to send requests through
+    - included_accounts, paginate, page_size, skip, token, incremental:
+      see canvas_utility.get_assignments; an incremental sync runs
+      canvas_utility.sync_assignments in a worker thread
+
+    returns:
+    - a list of Assignments, or an empty list if an error occurred
+    '''
+
+    if token is None:
+        token = canvas.load_credentials()['token']
+
+    # the snapshot logic is only written once, synchronously
+    if incremental:
+        return await asyncio.to_thread(canvas.sync_assignments,
+            included_accounts, skip, token)
+
+    print('Fetching assignments from Canvas')
+
+    # every course with all of its assignments in one query
+    if not paginate:
+        data = await _send_query(client, canvas.ASSIGNMENTS_QUERY, token=token)
+        if not data:
+            print('Error fetching assignments from Canvas')
+            return []
+        return list(canvas.iter_courses_assignments(data['allCourses'],
+            included_accounts, skip))
+
+    data = await _send_query(client, canvas.COURSES_QUERY, token=token)
+    if not data:
+        print('Error fetching courses from Canvas')
+        return []
+
+    today_iso = dt.now().isoformat()
+    courses = canvas.active_courses(data['allCourses'], included_accounts,
+        today_iso)
+
+    async def page_through(code, course):
+        assignments = []
+        cursor = None
+        while True:
+            page = await _send_query(client, canvas.ASSIGNMENTS_PAGE_QUERY,
+                canvas.page_variables(course, page_size, cursor), token)
+            page_assignments, cursor = canvas.read_page(code, page,
+                today_iso, skip)
+            assignments.extend(page_assignments)
+            if cursor is None:
+                return assignments
+
+    pages = await asyncio.gather(*(page_through(code, c) for (code, c) in courses))
+    return [a for assignments in pages for a in assignments]
+
+
+async def get_trello_assignments(client, query, board_id, trello_lists,
+    store=None, include_desc=False):
+    '''
+    Gets the assignments of every card in the specified lists with a single
+    board-level request, like trello_utility.get_assignments with a board ID.
+
+    params:
+    - client: the AsyncHttpClient to send requests through
+    - query, board_id, trello_lists, store, include_desc:
+      see trello_utility.get_assignments
+
+    returns:
+    - a list of Assignments for all the cards in the lists
+    '''
+
+    fields = trello.CARD_FIELDS + (',desc' if include_desc else '')
+
+    if store is not None:
+        await _sync_store(client, query, board_id, trello_lists, store, fields)
+        return store.assignments(set(trello_lists.values()))
+
+    cards = await _get_board_cards(client, query, board_id, trello_lists, fields)
+    return [a for a in map(trello.trello_card_to_assignment, cards) if a]
+
+
+async def _get_board_cards(client, query, board_id, trello_lists, fields):
+    '''
+    Downloads the open cards of the whole board in a single request and
+    keeps the ones in the specified lists, like
+    trello_utility._get_board_cards.
+    '''
+
+    response = await client.request(
+        'GET',
+        f'{trello.API_URL}/boards/{board_id}/cards',
+        params=trello.board_cards_params(query, fields)
+    )
+    return trello.listed_cards(response, trello_lists)
+
+
+async def _sync_store(client, query, board_id, trello_lists, store, fields):
+    '''
+    Syncs the local store with the board like trello_utility.get_assignments,
+    downloading the changed cards at the same time. The store's cursor only
+    moves once a sync is done, so a cancelled sync is redone by the next run.
+    '''
+
+    if trello.store_is_synced(store, board_id, trello_lists):
+        response = await client.request(
+            'GET',
+            f'{trello.API_URL}/boards/{board_id}/actions',
+            params=trello.actions_params(query, store.cursor)
+        )
+        actions = json.loads(response.text)
+        card_ids = trello.changed_card_ids(actions)
+        if card_ids is not None:
+            responses = await asyncio.gather(*(client.request(
+                'GET',
+                f'{trello.API_URL}/cards/{card_id}',
+                params=trello.changed_card_params(query, fields)
+            ) for card_id in card_ids))
+            trello.apply_changed_cards(store, actions, zip(card_ids, responses))
+            return
+
+    since = trello.sync_timestamp()
+    trello.fill_store(store, board_id, trello_lists, await _get_board_cards(
+        client, query, board_id, trello_lists, fields), since)
+
+
+async def _create_card(client, query, assignment, list_id, label_id):
+    '''
+    Creates a labelled Trello card like trello_utility._create_card,
+    waiting out Trello's rate limit without blocking the event loop.
+
+    returns:
+    - the ID of the new card
+
+    raises:
+    - trello_utility.UnknownLabelError if Trello refused the label
+    - requests.HTTPError if Trello refused to create the card otherwise
+    '''
+
+    params = trello.card_params(query, assignment, list_id, label_id)
+
+    for attempt in range(trello.MAX_RETRIES + 1):
+        await trello.RATE_LIMITER.take_async()
+        response = await client.request('POST', trello.API_URL + '/cards',
+            params=params)
+
+        card_id = trello.created_card_id(response, attempt)
+        if card_id is not None:
+            return card_id
+        await asyncio.sleep(http_utility.retry_delay(response, attempt))
+
+
+async def upload_assignments(client, query, assignments, board_id, list_id,
+    board_cache=None, create_labels=None):
+    '''
+    Adds a list of assignments to the specified Trello board like
+    trello_utility.upload_assignments, creating every card at once
+    within the per-host and Trello rate limits.
+
+    params:
+    - client: the AsyncHttpClient to send requests through
+    - query, assignments, board_id, list_id, board_cache, create_labels:
+      see trello_utility.upload_assignments
+
+    returns:
+    - a list with a report for each assignment, in order
+      (see trello_utility.upload_assignments)
+    '''
+
+    if board_cache is None:
+        board_cache = trello.get_board_cache()
+    if create_labels is None:
+        create_labels = '--create-labels' in sys.argv[1:]
+
+    # the labels are shared with the threaded uploader; the board cache
+    # is file-backed and rarely downloads anything, so it runs in a thread
+    uploader = trello.CardUploader(query, board_id, list_id, board_cache,
+        await asyncio.to_thread(board_cache.labels, query, board_id))
+    if create_labels:
+        await asyncio.to_thread(uploader.add_labels,
+            {a.class_name for a in assignments})
+
+    print('Adding {} new assignments to Trello'.format(len(assignments)))
+
+    async def create(a, label_id):
+        try:
+            return await _create_card(client, query, a, list_id, label_id)
+        except trello.UnknownLabelError:
+            label_id = await asyncio.to_thread(uploader.refresh_label,
+                a.class_name, label_id)
+            if label_id is None:
+                raise
+            return await _create_card(client, query, a, list_id, label_id)
+
+    async def upload(a):
+        label_id = uploader.label(a.class_name)
+        if label_id is None:
+            label_id = await asyncio.to_thread(uploader.missing_label,
+                a.class_name)
+        if label_id is None:
+            return trello.card_report(a)
+
+        try:
+            return trello.card_report(a, await create(a, label_id))
+        except Exception as e:
+            return trello.card_report(a, error=e)
+
+    reports = list(await asyncio.gather(*(upload(a) for a in assignments)))
+
+    count = sum(1 for r in reports if r['status'] == 'created')
+    print('{} assignments added\n'.format(count))
+
+    return reports
+
+
+async def _timed(name, coroutine, timeout):
+    '''
+    Runs a source, cancelling it if it takes longer than the timeout.
+
+    returns:
+    - a tuple of the source's result (None if it failed or timed out)
+      and elapsed seconds
+    '''
+
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(coroutine, timeout)
+    except asyncio.TimeoutError:
+        print('{} took longer than {}s and was cancelled'.format(name, timeout))
+        result = None
+    except Exception as e:
+        print('Error fetching {}: {}'.format(name, e))
+        result = None
+    return (result, time.perf_counter() - start)
+
+
+async def run(query, board_id, trello_lists, sites_info, token,
+    timeout=SOURCE_TIMEOUT, connections=http_utility.POOL_MAXSIZE,
+    paginate=False, dry_run=False, store=None, incremental=False):
+    '''
+    Fetches Trello, the CS sites, and Canvas at the same time and adds every
+    new assignment to Trello in one upload pass, without asking.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - sites_info: a dictionary of class name to site info
+    - token: the Canvas API token
+    - timeout: seconds each source may take before it is cancelled
+    - connections: the most requests sent to a single host at once
+    - paginate: page through the active Canvas courses
+      (see canvas_utility.iter_assignments)
+    - dry_run: only find the new assignments, don't add them
+    - store: an AssignmentStore to sync Trello cards into, or None
+    - incremental: only download the Canvas assignments that changed
+      since the last run (see canvas_utility.sync_assignments)
+
+    returns:
+    - a tuple of the diff (see main.diff_new_assignments) and the upload
+      report (like main.apply_new_assignments), which is None for a dry run;
+      None instead if the Trello cards couldn't be fetched
+    '''
+
+    # past-due assignments are always thrown away by the dedup step,
+    # so the sources can leave them out
+    skip = AssignmentIndex().is_past
+
+    async with AsyncHttpClient(connections) as client:
+        sources = {
+            'Trello': get_trello_assignments(client, query, board_id, trello_lists,
+                store),
+            'CS sites': get_sites_assignments(client, list(sites_info.items()),
+                skip=skip),
+            'Canvas': get_canvas_assignments(client, ['Undergrad Programs'],
+                paginate, skip=skip, token=token, incremental=incremental),
+        }
+        results = dict(zip(sources, await asyncio.gather(
+            *(_timed(name, coroutine, timeout)
+                for (name, coroutine) in sources.items()))))
+
+        print('\nStage timings:')
+        for (name, (_, elapsed)) in results.items():
+            print('{:<12}{:.2f}s'.format(name, elapsed))
+        print()
+
+        # without the cards on Trello, every assignment would look new
+        if results['Trello'][0] is None:
+            print('Trello cards could not be fetched, nothing was added')
+            return None
+
+        # in the order the sites are listed in site_info
+        cs_assignments = [a for site_assignments in results['CS sites'][0] or []
+            for a in site_assignments]
+        diff = diff_new_assignments(AssignmentIndex(results['Trello'][0]),
+            {'CS sites': cs_assignments, 'Canvas': results['Canvas'][0] or []})
+        if dry_run:
+            return (diff, None)
+
+        reports = []
+        if diff:
+            reports = await upload_assignments(client, query,
+                [a for (_, a) in diff], board_id, trello_lists['To-Do'])
+
+    for ((source, a), report) in zip(diff, reports):
+        report['source'] = source
+        report['due'] = a.due
+
+    return (diff, summarize(reports))
+
+
+def main():
+    '''
+    Loads program data from files, finds the new assignments on every
+    source on one event loop, and adds them to Trello without asking
+    (or lists them with --dry-run).
+    '''
+
+    # while --dry-run or --report prints JSON, everything else is printed
+    # to stderr so that the JSON can be piped
+    stdout = sys.stdout
+    if json_to_stdout():
+        with contextlib.redirect_stdout(sys.stderr):
+            _main(stdout)
+    else:
+        _main(stdout)
+
+
+def _main(stdout):
+    '''
+    Runs the program (see main), printing any JSON to stdout.
+    '''
+
+    query = trello.load_credentials()
+    board_id, trello_lists = trello.load_board_info()
+    token = canvas.load_credentials()['token']
+    sites_info = cs_scraper.load_sites_info()
+
+    # converted descriptions are kept between runs unless --no-cache
+    if '--no-cache' not in sys.argv[1:]:
+        markdown_utility.configure(path=markdown_utility.CACHE_PATH)
+
+    # the same local copy of the Trello cards as main.py
+    store = AssignmentStore()
+    if '--full-sync' in sys.argv[1:]:
+        store.clear()
+
+    dry_run = config_utility.option('--dry-run', '-')
+    result = asyncio.run(run(query, board_id, trello_lists, sites_info, token,
+        timeout=float(config_utility.option('--timeout') or SOURCE_TIMEOUT),
+        connections=int(config_utility.option('--connections')
+            or http_utility.POOL_MAXSIZE),
+        paginate='--paginate' in sys.argv[1:], dry_run=bool(dry_run),
+        store=store, incremental='--incremental' in sys.argv[1:]))
+    store.close()
+    if result is None:
+        sys.exit(1)
+
+    diff, report = result
+    if dry_run:
+        write_json(dry_run, {'new': [
+            dict(a.to_dict(render=True), source=source) for (source, a) in diff]},
+            stdout)
+    else:
+        print('{} created, {} skipped (no Trello label), {} failed'.format(
+            report['created'], report['skipped'], report['failed']))
+        report_path = config_utility.option('--report', '-')
+        if report_path:
+            write_json(report_path, report, stdout)
+
+    markdown_utility.get_cache().save()
+
+
+if __name__ == '__main__':
+    main()
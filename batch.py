@@ -0,0 +1,250 @@
+'''
+Batch driver that checks the assignments of a whole cohort in one process.
+
+Every subdirectory of the bundles directory holds one student's
+credentials.json, site-info.json, and trello-info.json (see README).
+Course sites shared by several students are only downloaded once, each
+student's Trello and Canvas work runs concurrently under rate limits shared
+by all students, and new assignments are added to Trello without asking.
+
+Usage:
+
+    python batch.py <bundles-directory> [--workers=N] [--no-cache] [--lxml]
+        [--processes[=N]] [--paginate] [--incremental] [--full-sync]
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from dedup_utility import AssignmentIndex
+from state_utility import AssignmentStore
+import os, sys, time
+import config_utility, http_utility, markdown_utility
+import gfu_utility as cs_scraper
+import trello_utility as trello
+import canvas_utility as canvas
+
+
+# default number of students whose Trello and Canvas work runs at once
+USER_WORKERS = 4
+
+# requests per second to each API, summed over every student
+TRELLO_RATE = 25
+CANVAS_RATE = 10
+
+# each student's local copy of their Trello cards
+STORE_DIR = os.path.join('.cache', 'users')
+
+
+def load_bundles(directory):
+    '''
+    Loads every student's bundle from a directory. A bundle that can't be
+    loaded is still returned, with its error, so it shows up in the summary.
+
+    params:
+    - directory: a directory with one subdirectory per student
+
+    returns:
+    - a list of dictionaries with the keys name, path, query, board_id,
+      lists, canvas_token, sites_info, and error, sorted by name
+    '''
+
+    bundles = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isdir(path):
+            continue
+
+        bundle = {'name': name, 'path': path, 'query': None, 'board_id': None,
+            'lists': {}, 'canvas_token': None, 'sites_info': {}, 'error': None}
+        try:
+            credentials_path = os.path.join(path, 'credentials.json')
+            bundle['query'] = trello.load_credentials(credentials_path)
+            bundle['board_id'], bundle['lists'] = \
+                trello.load_board_info(os.path.join(path, 'trello-info.json'))
+            bundle['sites_info'] = config_utility.load_json(
+                os.path.join(path, 'site-info.json'))
+
+            # Canvas is optional for a student
+            credentials = config_utility.load_json(credentials_path)
+            if 'canvas' in credentials:
+                bundle['canvas_token'] = canvas.load_credentials(credentials_path)['token']
+
+        # the loaders quit the program on a bad file; here only this student fails
+        except SystemExit:
+            bundle['error'] = 'could not load bundle'
+
+        bundles.append(bundle)
+
+    return bundles
+
+
+def _collect_user(bundle, skip):
+    '''
+    Syncs a student's Trello cards and fetches their Canvas assignments.
+
+    params:
+    - bundle: the student's bundle (see load_bundles)
+    - skip: a function that returns True for assignments that will be
+      thrown away anyway
+
+    returns:
+    - a tuple of the student's Trello and Canvas assignments
+    '''
+
+    store = AssignmentStore(os.path.join(STORE_DIR, bundle['name'], 'assignments.db'))
+    try:
+        if '--full-sync' in sys.argv[1:]:
+            store.clear()
+        trello_assignments = trello.get_assignments(bundle['query'],
+            bundle['lists'], board_id=bundle['board_id'], store=store,
+            include_desc=False)
+    finally:
+        store.close()
+
+    canvas_assignments = []
+    if bundle['canvas_token']:
+        canvas_assignments = canvas.get_assignments(
+            included_accounts=['Undergrad Programs'],
+            paginate='--paginate' in sys.argv[1:], skip=skip,
+            token=bundle['canvas_token'],
+            incremental='--incremental' in sys.argv[1:]) or []
+
+    return (trello_assignments, canvas_assignments)
+
+
+def _upload_user(bundle, trello_assignments, cs_assignments, canvas_assignments):
+    '''
+    Adds a student's new CS site and Canvas assignments to Trello.
+
+    returns:
+    - a summary dictionary with the student's counts
+    '''
+
+    known = AssignmentIndex(trello_assignments)
+    new_cs = known.filter_new(cs_assignments)
+
+    # account for assignments that appear on CS sites *and* Canvas
+    known.extend(new_cs)
+    new_canvas = known.filter_new(canvas_assignments)
+
+    reports = []
+    if new_cs or new_canvas:
+        reports = trello.upload_assignments(bundle['query'], new_cs + new_canvas,
+            bundle['board_id'], bundle['lists']['To-Do'],
+            board_cache=trello.BoardCache(
+                os.path.join(bundle['path'], trello.BOARD_CACHE_FILE)))
+
+    summary = {'trello': len(trello_assignments), 'cs': len(new_cs),
+        'canvas': len(new_canvas)}
+    for status in ('created', 'skipped', 'failed'):
+        summary[status] = sum(1 for r in reports if r['status'] == status)
+    return summary
+
+
+def run(bundles, max_workers=USER_WORKERS):
+    '''
+    Checks every student for new assignments and adds them to Trello.
+
+    The course sites of all students are fetched together (each URL once)
+    while the students' Trello and Canvas work runs max_workers at a time.
+
+    params:
+    - bundles: the students' bundles (see load_bundles)
+    - max_workers: the most students worked on at once
+
+    returns:
+    - a list of summary dictionaries, one per bundle, with the keys name,
+      trello, cs, canvas, created, skipped, failed, seconds, and error
+    '''
+
+    # Trello and Canvas limits are shared by every student's requests
+    client = http_utility.get_client()
+    client.limit(urlsplit(trello.API_URL).hostname, TRELLO_RATE)
+    client.limit(urlsplit(canvas.ENDPOINT).hostname, CANVAS_RATE)
+
+    # past-due assignments are always thrown away by the dedup step
+    skip = AssignmentIndex().is_past
+
+    users = [b for b in bundles if not b['error']]
+    sites = [(class_name, site_info)
+        for b in users for (class_name, site_info) in b['sites_info'].items()]
+    summaries = {b['name']: {'name': b['name'], 'error': b['error']} for b in bundles}
+
+    def timed(bundle, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except (Exception, SystemExit) as e:
+            summaries[bundle['name']]['error'] = str(e) or type(e).__name__
+        finally:
+            summaries[bundle['name']]['seconds'] = \
+                summaries[bundle['name']].get('seconds', 0) \
+                + time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        collected = [pool.submit(timed, b, _collect_user, b, skip) for b in users]
+
+        # every student's course sites at once, shared pages only once
+        site_assignments = iter(cs_scraper.get_sites_assignments(sites, skip=skip))
+
+        uploads = []
+        for (bundle, future) in zip(users, collected):
+            cs_assignments = []
+            for _ in bundle['sites_info']:
+                cs_assignments.extend(next(site_assignments))
+
+            result = future.result()
+            if result:
+                uploads.append((bundle, pool.submit(timed, bundle,
+                    _upload_user, bundle, result[0], cs_assignments, result[1])))
+
+        for (bundle, future) in uploads:
+            summaries[bundle['name']].update(future.result() or {})
+
+    return [summaries[b['name']] for b in bundles]
+
+
+def print_summary(summaries):
+    '''
+    Prints a table of what was found and added for every student.
+    '''
+
+    print('\n{:<20}{:>8}{:>8}{:>8}{:>8}{:>8}{:>8}{:>9}'.format(
+        'Student', 'Trello', 'CS', 'Canvas', 'added', 'skipped', 'failed', 'time'))
+    for s in summaries:
+        if s.get('error'):
+            print('{:<20}error: {}'.format(s['name'], s['error']))
+        else:
+            print('{:<20}{:>8}{:>8}{:>8}{:>8}{:>8}{:>8}{:>8.1f}s'.format(
+                s['name'], s['trello'], s['cs'], s['canvas'],
+                s['created'], s['skipped'], s['failed'], s['seconds']))
+    print()
+
+
+def main():
+    '''
+    Loads every bundle in the directory given in program args,
+    adds each student's new assignments to Trello, and prints a summary.
+    '''
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not args or not os.path.isdir(args[0]):
+        print('Usage: python batch.py <bundles-directory> [--workers=N]')
+        sys.exit(1)
+
+    # converted descriptions are shared by every student
+    if '--no-cache' not in sys.argv[1:]:
+        markdown_utility.configure(path=markdown_utility.CACHE_PATH)
+
+    bundles = load_bundles(args[0])
+    print('Loaded {} student bundles'.format(len(bundles)))
+
+    summaries = run(bundles,
+        int(config_utility.option('--workers') or USER_WORKERS))
+    print_summary(summaries)
+
+    markdown_utility.get_cache().save()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,536 @@
+'''
+Benchmarks for the slow paths of the assignment scraper.
+
+The source benchmarks run every stage of a scrape against the recorded
+responses in fixtures/, served by a local FixtureServer at each scale.
+
+The parsing benchmark parses many course pages in this process and then
+in process pools of growing size to show how parsing scales across cores.
+
+The import benchmark times importing the scraper in a fresh interpreter.
+
+The pipeline benchmark runs a whole unattended scrape both ways, collecting
+every source first or streaming, for the time to the first card and the
+peak memory.
+
+Run with:
+
+    python benchmark.py [--size N] [--records N] [--scales 1,10,100]
+        [--repeat N] [--pages N] [--output results.json]
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+from fixture_server import FixtureServer, FIXTURES, LISTS, scale_site
+import argparse, gc, io, json, os, platform, random, string, subprocess, sys, tempfile, time, tracemalloc
+from assignment_utility import Assignment
+from dedup_utility import AssignmentIndex, normalize_key
+import gfu_utility, canvas_utility, trello_utility, markdown_utility, main
+
+
+def _random_title(rng):
+    return ''.join(rng.choice(string.ascii_letters + ' ') for _ in range(24))
+
+
+def _synthetic_assignments(rng, count, classes=40):
+    '''
+    Generates fake assignments spread over a handful of classes with due
+    dates either side of today.
+
+    params:
+    - rng: a random.Random instance
+    - count: number of assignments to generate
+    - classes: number of distinct class codes
+
+    returns:
+    - a list of Assignments
+    '''
+
+    today = date.today()
+    assignments = []
+    for _ in range(count):
+        due = today + timedelta(days=rng.randint(-120, 120))
+        assignments.append(Assignment(
+            'CSIS {}'.format(100 + rng.randrange(classes)),
+            _random_title(rng),
+            '{}T23:59:00'.format(due.isoformat()),
+            description=''))
+    return assignments
+
+
+def _nested_loop_filter(old_assignments, new_assignments):
+    '''
+    The original O(n*m) implementation of main.filter_new_assignments,
+    kept here as the baseline.
+    '''
+
+    result = []
+    for a_new in new_assignments:
+        upcoming = a_new.due > date.today().isoformat()
+        if upcoming:
+            exclusive = True
+            for a_old in old_assignments:
+                if a_new.title == a_old.title \
+                and a_new.class_name == a_old.class_name:
+                    exclusive = False
+                    break
+            if exclusive:
+                result.append(a_new)
+    return result
+
+
+def bench_dedup(size):
+    '''
+    Times the nested loop against the hash index with `size` Trello cards
+    and `size` scraped assignments, half of which are already on Trello.
+
+    returns:
+    - a list of result dicts
+    '''
+
+    rng = random.Random(0)
+    old = _synthetic_assignments(rng, size)
+    new = old[:size // 2] + _synthetic_assignments(rng, size - size // 2)
+    rng.shuffle(new)
+
+    start = time.perf_counter()
+    expected = _nested_loop_filter(old, new)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = AssignmentIndex(old)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = index.filter_new(new)
+    lookup_time = time.perf_counter() - start
+
+    assert result == expected, 'index and nested loop disagree'
+
+    index_time = build_time + lookup_time
+    print('dedup {}x{}'.format(size, size))
+    print('  nested loop:\t{:.3f}s'.format(loop_time))
+    print('  hash index:\t{:.3f}s (build {:.3f}s, lookup {:.3f}s)'
+        .format(index_time, build_time, lookup_time))
+    print('  speedup:\t{:.0f}x'.format(loop_time / index_time))
+
+    return [
+        {'bench': 'dedup', 'stage': 'nested loop', 'records': size,
+            'seconds': loop_time},
+        {'bench': 'dedup', 'stage': 'hash index', 'records': size,
+            'seconds': index_time},
+    ]
+
+
+def _measure(make, count):
+    '''
+    Returns the bytes allocated (and still alive) by make(i) for i < count.
+    '''
+
+    gc.collect()
+    tracemalloc.start()
+    records = [make(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def bench_memory(count):
+    '''
+    Compares the memory used by `count` Assignments with the same number
+    of the plain dicts that assignments used to be.
+
+    returns:
+    - a list of result dicts
+    '''
+
+    titles = ['Homework {}'.format(i) for i in range(count)]
+    classes = ['CSIS {}'.format(100 + i % 40) for i in range(count)]
+    due = '2020-10-05T23:59:00'
+
+    # the old four-key dicts, then dicts that also hold the dedup key
+    # Assignment precomputes so the comparison is fair
+    sizes = [
+        ('dicts', _measure(lambda i: {
+            'class': classes[i], 'due': due, 'title': titles[i],
+            'description': ''}, count)),
+        ('dicts + dedup key', _measure(lambda i: {
+            'class': sys.intern(classes[i]), 'due': due, 'title': titles[i],
+            'description': '', 'key': normalize_key(classes[i], titles[i])},
+            count)),
+        ('Assignments', _measure(lambda i: Assignment(
+            classes[i], titles[i], due, description=''), count)),
+    ]
+
+    print('memory for {} records'.format(count))
+    for (name, size) in sizes:
+        print('  {:<22}{:.1f} MB ({} B each)'.format(
+            name + ':', size / 1e6, size // count))
+
+    return [{'bench': 'memory', 'stage': name, 'records': count, 'bytes': size}
+        for (name, size) in sizes]
+
+
+def bench_parsing(pages, scale=10):
+    '''
+    Times parsing `pages` course pages (the fixture pages with `scale` times
+    as many rows) in this process and in process pools of 1, 2, 4, ...
+    workers, up to the number of CPUs.
+
+    returns:
+    - a list of result dicts
+    '''
+
+    htmls = []
+    for name in sorted(os.listdir(os.path.join(FIXTURES, 'sites'))):
+        with open(os.path.join(FIXTURES, 'sites', name), encoding='utf-8') as f:
+            htmls.append(('CSIS ' + name[5:8], scale_site(f.read(), scale)))
+    jobs = [htmls[i % len(htmls)] for i in range(pages)]
+
+    start = time.perf_counter()
+    expected = [gfu_utility._parse_site_tuples(c, h, 2020) for (c, h) in jobs]
+    baseline = time.perf_counter() - start
+
+    print('parsing {} pages ({}x rows)'.format(pages, scale))
+    print('  in process:\t{:.3f}s ({:.0f} pages/s)'.format(baseline, pages / baseline))
+    results = [{'bench': 'parsing', 'stage': 'in process', 'processes': 0,
+        'records': pages, 'seconds': baseline}]
+
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+
+    for count in counts:
+        with ProcessPoolExecutor(count) as workers:
+            # start the workers (and their imports) before timing
+            list(workers.map(abs, range(count)))
+
+            start = time.perf_counter()
+            futures = [workers.submit(gfu_utility._parse_site_tuples, c, h, 2020)
+                for (c, h) in jobs]
+            result = [f.result() for f in futures]
+            elapsed = time.perf_counter() - start
+
+        assert result == expected, 'process pool and in process parsing disagree'
+        print('  {} processes:\t{:.3f}s ({:.0f} pages/s, {:.1f}x)'.format(
+            count, elapsed, pages / elapsed, baseline / elapsed))
+        results.append({'bench': 'parsing', 'stage': 'process pool',
+            'processes': count, 'records': pages, 'seconds': elapsed})
+
+    return results
+
+
+# modules timed by the import benchmark; the libraries are the ones the
+# scraper only imports once it needs them
+IMPORTS = ['main', 'bs4', 'markdownify', 'requests']
+HEAVY_MODULES = ['bs4', 'markdownify', 'requests']
+
+_IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import {}
+elapsed = time.perf_counter() - start
+print(elapsed, *[m for m in {!r} if m in sys.modules])
+'''
+
+
+def bench_imports(repeat=5):
+    '''
+    Times importing each module in IMPORTS in a fresh interpreter, the
+    cost every run of the scraper pays before doing anything, and lists
+    which of HEAVY_MODULES each import pulled in.
+
+    returns:
+    - a list of result dicts
+    '''
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    print('imports (fresh interpreter, best of {})'.format(repeat))
+    results = []
+    for module in IMPORTS:
+        script = _IMPORT_SCRIPT.format(module, HEAVY_MODULES)
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', script], cwd=here,
+                capture_output=True, text=True, check=True).stdout.split()
+            runs.append((float(output[0]), output[1:]))
+        elapsed, loaded = min(runs)
+
+        print('  {:<14}{:>8.1f}ms  loads {}'.format(module + ':', elapsed * 1e3,
+            ', '.join(loaded) or 'none of them'))
+        results.append({'bench': 'imports', 'stage': module, 'seconds': elapsed,
+            'loaded': loaded})
+
+    return results
+
+
+def _time_stage(server, make_call, repeat):
+    '''
+    Runs a stage `repeat` times against the fixture server with its output
+    silenced and keeps the fastest run.
+
+    params:
+    - server: the FixtureServer the stage talks to
+    - make_call: returns a fresh zero-argument function running the stage;
+      called before each run, outside the timing
+    - repeat: number of runs
+
+    returns:
+    - a tuple of the stage's result, best time, and requests and bytes
+      served during one run
+    '''
+
+    best = None
+    for _ in range(max(1, repeat)):
+        call = make_call()
+        server.reset_counters()
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = call()
+            elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[1]:
+            best = (result, elapsed, server.requests, server.bytes_sent)
+    return best
+
+
+def bench_sources(scales, repeat=3):
+    '''
+    Times each stage of a scrape (course sites, Canvas, Trello, dedup, and
+    upload) against the local fixture server at every scale.
+
+    params:
+    - scales: how many times to multiply the recorded data, e.g. [1, 10, 100]
+    - repeat: runs per stage; the fastest is kept
+
+    returns:
+    - a list of result dicts
+    '''
+
+    server = FixtureServer().start()
+    query = {'key': 'benchmark', 'token': 'benchmark'}
+    board_id = 'benchmark'
+    trello_lists = {name: id for (name, id) in LISTS if name != 'Done'}
+    sites_info = {
+        name[:-len('.html')].replace('-', ' ').upper(): {
+            'url': '{}/sites/{}'.format(server.url, name), 'headers': {}}
+        for name in sorted(os.listdir(os.path.join(FIXTURES, 'sites')))}
+
+    # point every source at the fixture server; uploads aren't rate limited
+    saved = (trello_utility.API_URL, trello_utility.RATE_LIMITER,
+        canvas_utility.ENDPOINT, sys.argv, os.getcwd())
+    trello_utility.API_URL = server.url + '/1'
+    trello_utility.RATE_LIMITER = trello_utility.TokenBucket(rate=1e9, capacity=1e9)
+    canvas_utility.ENDPOINT = server.url + '/api/graphql'
+
+    # the sources read these from the program args: the page cache would
+    # skip parsing unchanged pages after the first run, and an unpaginated
+    # Canvas query is held whole, which the stream can't bound
+    sys.argv = [sys.argv[0], '--no-cache', '--paginate']
+
+    # the Canvas token is read from credentials.json in the working directory
+    workdir = tempfile.TemporaryDirectory()
+    with open(os.path.join(workdir.name, 'credentials.json'), 'w') as f:
+        json.dump({'trello': query, 'canvas': {'token': 'benchmark'}}, f)
+    os.chdir(workdir.name)
+
+    def get_sites():
+        assignments = []
+        for (class_name, site_info) in sites_info.items():
+            assignments.extend(gfu_utility._get_site_assignments(class_name, site_info))
+        return assignments
+
+    def canvas_incremental(scale):
+        # times a steady-state run; the first sync (outside the timing)
+        # fills the snapshot
+        snapshot = os.path.join(workdir.name, 'canvas-{}.json'.format(scale))
+        call = lambda: canvas_utility.sync_assignments(['Undergrad Programs'],
+            snapshot_path=snapshot)
+        with redirect_stdout(io.StringIO()):
+            call()
+        return call
+
+    def upload(assignments):
+        # fresh copies and an empty Markdown cache, so every run converts
+        # every description like a real first upload would
+        copies = [Assignment.from_dict(a.to_dict()) for a in assignments]
+        markdown_utility.configure()
+        return lambda: trello_utility.upload_assignments(
+            query, copies, board_id, trello_lists['To-Do'])
+
+    results = []
+    try:
+        for scale in scales:
+            server.scale = scale
+            stages = {}
+
+            stages['CS sites'] = _time_stage(server, lambda: get_sites, repeat)
+            stages['Canvas'] = _time_stage(server, lambda: lambda: \
+                canvas_utility.get_assignments(['Undergrad Programs']), repeat)
+            stages['Canvas (paginated)'] = _time_stage(server, lambda: lambda: \
+                canvas_utility.get_assignments(['Undergrad Programs'], paginate=True),
+                repeat)
+            stages['Canvas (incremental)'] = _time_stage(server,
+                lambda: canvas_incremental(scale), repeat)
+            # every field of every card, one request per list
+            stages['Trello (per list)'] = _time_stage(server, lambda: lambda: [
+                a for a in map(trello_utility.trello_card_to_assignment,
+                    trello_utility._get_list_cards(query, trello_lists))
+                if a], repeat)
+            stages['Trello'] = _time_stage(server, lambda: lambda: \
+                trello_utility.get_assignments(query, trello_lists, board_id),
+                repeat)
+            stages['Trello (no desc)'] = _time_stage(server, lambda: lambda: \
+                trello_utility.get_assignments(query, trello_lists, board_id,
+                    include_desc=False), repeat)
+
+            scraped = stages['CS sites'][0] + stages['Canvas'][0]
+            stages['dedup'] = _time_stage(server, lambda: lambda: \
+                main.filter_new_assignments(stages['Trello'][0], scraped), repeat)
+            stages['upload'] = _time_stage(server,
+                lambda: upload(stages['dedup'][0]), repeat)
+
+            print('sources at scale {}'.format(scale))
+            for (name, (result, elapsed, requests, sent)) in stages.items():
+                print('  {:<22}{:>7} records {:>8.3f}s {:>6} requests {:>10.1f} KB'
+                    .format(name + ':', len(result), elapsed, requests, sent / 1e3))
+                results.append({'bench': 'sources', 'stage': name, 'scale': scale,
+                    'records': len(result), 'seconds': elapsed,
+                    'requests': requests, 'bytes': sent})
+
+    finally:
+        (trello_utility.API_URL, trello_utility.RATE_LIMITER,
+            canvas_utility.ENDPOINT, sys.argv, cwd) = saved
+        os.chdir(cwd)
+        workdir.cleanup()
+        server.stop()
+
+    return results
+
+
+def bench_pipeline(scales):
+    '''
+    Runs a whole unattended scrape (like main.py --yes --no-cache
+    --paginate) against the local fixture server at every scale, once
+    collecting every source before deduping and uploading, and once as a
+    stream (see main.stream_new_assignments), measuring how long it takes
+    until the first card is created and the peak memory allocated. Every
+    run downloads and parses every course page and Canvas page.
+
+    params:
+    - scales: how many times to multiply the recorded data, e.g. [1, 10, 100]
+
+    returns:
+    - a list of result dicts
+    '''
+
+    server = FixtureServer().start()
+    query = {'key': 'benchmark', 'token': 'benchmark'}
+    board_id = 'benchmark'
+    trello_lists = {name: id for (name, id) in LISTS if name != 'Done'}
+
+    saved = (trello_utility.API_URL, trello_utility.RATE_LIMITER,
+        canvas_utility.ENDPOINT, os.getcwd())
+    trello_utility.API_URL = server.url + '/1'
+    trello_utility.RATE_LIMITER = trello_utility.TokenBucket(rate=1e9, capacity=1e9)
+    canvas_utility.ENDPOINT = server.url + '/api/graphql'
+
+    # the sources read their credentials and sites from the working directory
+    workdir = tempfile.TemporaryDirectory()
+    with open(os.path.join(workdir.name, 'credentials.json'), 'w') as f:
+        json.dump({'trello': query, 'canvas': {'token': 'benchmark'}}, f)
+    with open(os.path.join(workdir.name, 'site-info.json'), 'w') as f:
+        json.dump({
+            name[:-len('.html')].replace('-', ' ').upper(): {
+                'url': '{}/sites/{}'.format(server.url, name), 'headers': {}}
+            for name in sorted(os.listdir(os.path.join(FIXTURES, 'sites')))}, f)
+    os.chdir(workdir.name)
+
+    def batch():
+        trello_assignments, cs_assignments, canvas_assignments = \
+            main.collect_assignments(query, board_id, trello_lists)
+        diff = main.diff_new_assignments(AssignmentIndex(trello_assignments),
+            {'CS sites': cs_assignments, 'Canvas': canvas_assignments})
+        return trello_utility.upload_assignments(query,
+            [a for (_, a) in diff], board_id, trello_lists['To-Do'])
+
+    def stream():
+        return main.apply_new_assignments(query, board_id, trello_lists['To-Do'],
+            main.stream_new_assignments(query, board_id, trello_lists))['cards']
+
+    def run(pipeline):
+        # an empty Markdown cache, so every run converts every description
+        markdown_utility.configure()
+        gc.collect()
+        server.reset_counters()
+        with redirect_stdout(io.StringIO()):
+            tracemalloc.start()
+            start = time.perf_counter()
+            reports = pipeline()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return (reports, elapsed, server.first_card - start, peak)
+
+    results = []
+    try:
+        for scale in scales:
+            server.scale = scale
+            print('pipeline at scale {}'.format(scale))
+
+            # builds the scaled responses outside the measured runs
+            with redirect_stdout(io.StringIO()):
+                batch()
+
+            for (name, pipeline) in (('batch', batch), ('stream', stream)):
+                (reports, elapsed, first_card, peak) = run(pipeline)
+                print('  {:<22}{:>7} cards {:>8.3f}s {:>8.3f}s to first card {:>8.1f} MB peak'
+                    .format(name + ':', len(reports), elapsed, first_card, peak / 1e6))
+                results.append({'bench': 'pipeline', 'stage': name, 'scale': scale,
+                    'records': len(reports), 'seconds': elapsed,
+                    'first_card': first_card, 'peak_bytes': peak})
+
+    finally:
+        (trello_utility.API_URL, trello_utility.RATE_LIMITER,
+            canvas_utility.ENDPOINT, cwd) = saved
+        os.chdir(cwd)
+        workdir.cleanup()
+        server.stop()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=10000,
+        help='number of Trello cards and scraped assignments (default 10000)')
+    parser.add_argument('--records', type=int, default=100000,
+        help='number of records in the memory benchmark (default 100000)')
+    parser.add_argument('--scales', default='1,10,100',
+        help='comma-separated data scales for the source benchmarks (default 1,10,100)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per source stage, fastest is kept (default 3)')
+    parser.add_argument('--pages', type=int, default=200,
+        help='number of pages in the parsing benchmark (default 200)')
+    parser.add_argument('--output',
+        help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    results += bench_dedup(args.size)
+    results += bench_memory(args.records)
+    results += bench_parsing(args.pages)
+    results += bench_imports(args.repeat)
+    results += bench_sources([int(s) for s in args.scales.split(',')], args.repeat)
+    results += bench_pipeline([int(s) for s in args.scales.split(',')])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+        print('Results written to {}'.format(args.output))
@@ -0,0 +1,169 @@
+'''
+On-disk cache of course assignment pages.
+
+For every URL the cache remembers the ETag/Last-Modified validators, a hash
+of the page body, and the assignments that were parsed from it. Requests are
+sent as conditional GETs; when the server answers 304, or the body hashes the
+same as last time, the cached assignments are reused and the page is not
+parsed again.
+'''
+
+from threading import Lock
+import config_utility, http_utility, json, hashlib, os, time
+
+
+CACHE_PATH = os.path.join('.cache', 'http-cache.json')
+
+# entries not used for this many seconds are dropped
+MAX_AGE = 30 * 24 * 60 * 60
+
+# the cache file is trimmed (least recently used first) to this many bytes
+MAX_BYTES = 2 * 1024 * 1024
+
+
+class HttpCache:
+    '''
+    Conditional-GET cache keyed by URL. Call save() once done to write
+    the cache back to disk.
+    '''
+
+    def __init__(self, path=CACHE_PATH, max_age=MAX_AGE, max_bytes=MAX_BYTES):
+        '''
+        params:
+        - path: the JSON file the cache is stored in
+        - max_age: seconds an unused entry is kept
+        - max_bytes: the largest the cache file may grow
+        '''
+
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = config_utility.load_json_file(path)
+
+    def get(self, url, headers=None, timeout=None, retry=True):
+        '''
+        Sends a conditional GET for a URL.
+
+        params:
+        - url: the page to fetch
+        - headers: extra HTTP headers for the request
+        - timeout: seconds to wait for the server
+        - retry: if False, a failed request isn't retried
+
+        returns:
+        - a tuple (html, entry):
+          - html is the page body, or None if the page is unchanged,
+            in which case entry['assignments'] holds the cached result
+          - entry is the cache entry to fill in and put() after parsing,
+            or None if the response should not be cached
+        '''
+
+        response = http_utility.get(url,
+            headers=self.conditional_headers(url, headers), timeout=timeout,
+            retry=retry)
+        return self.resolve(url, response)
+
+    def conditional_headers(self, url, headers=None):
+        '''
+        Builds the headers of a conditional GET for a URL.
+
+        params:
+        - url: the page to fetch
+        - headers: extra HTTP headers for the request
+
+        returns:
+        - the extra headers plus the cached validators of the page, if any
+        '''
+
+        with self._lock:
+            cached = self._entries.get(url)
+
+        # ask the server to skip the body if we already have it
+        headers = dict(headers or {})
+        if cached and cached.get('assignments') is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+
+    def resolve(self, url, response):
+        '''
+        Checks the response to a conditional GET against the cache.
+
+        params:
+        - url: the page that was fetched
+        - response: the response, with status_code, headers, content,
+          and text like a requests.Response
+
+        returns:
+        - a tuple (html, entry) as returned by get
+        '''
+
+        with self._lock:
+            cached = self._entries.get(url)
+
+        # server says nothing changed
+        if response.status_code == 304 and cached:
+            self.put(url, cached)
+            return (None, cached)
+
+        # don't cache error pages
+        if response.status_code != 200:
+            return (response.text, None)
+
+        entry = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hash': hashlib.sha256(response.content).hexdigest(),
+            'assignments': None
+        }
+
+        # server sent the page again, but it hasn't changed
+        if cached and cached.get('hash') == entry['hash'] \
+        and cached.get('assignments') is not None:
+            entry['assignments'] = cached['assignments']
+            self.put(url, entry)
+            return (None, entry)
+
+        return (response.text, entry)
+
+    def put(self, url, entry):
+        '''
+        Stores a cache entry and marks it as just used.
+        '''
+
+        entry['used_at'] = time.time()
+        with self._lock:
+            self._entries[url] = entry
+
+    def _evict(self):
+        '''
+        Drops entries older than max_age, then the least recently used
+        entries until the cache fits in max_bytes.
+        '''
+
+        oldest = time.time() - self.max_age
+        entries = [(url, e) for (url, e) in self._entries.items()
+            if e.get('used_at', 0) >= oldest]
+
+        entries.sort(key=lambda item: item[1]['used_at'], reverse=True)
+        kept = {}
+        size = 0
+        for (url, e) in entries:
+            size += len(json.dumps({url: e}))
+            if size > self.max_bytes:
+                break
+            kept[url] = e
+
+        self._entries = kept
+
+    def save(self):
+        '''
+        Evicts stale entries and writes the cache to disk.
+        '''
+
+        with self._lock:
+            self._evict()
+            config_utility.save_json_file(self.path, self._entries)
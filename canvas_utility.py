@@ -1,189 +1,584 @@
 # https://canvas.beta.instructure.com/doc/api/file.graphql.html
-import requests, json, sys, re, os, markdownify
+import config_utility, http_utility, metrics_utility, json, sys, re, hashlib, os
 from datetime import datetime as dt
+from assignment_utility import Assignment
 
 
-# NOTE: should use HTTP authorization header instead
-ENDPOINT = 'https://georgefox.instructure.com/api/graphql?access_token={}'
+ENDPOINT = 'https://georgefox.instructure.com/api/graphql'
 
+# assignments requested per page in paginated mode
+PAGE_SIZE = 50
 
-def _load_credentials(path='credentials.json'):
+# assignments fetched per request by an incremental sync
+ASSIGNMENTS_PER_QUERY = 50
+
+# snapshot of every active course's assignments for incremental syncs,
+# one per Canvas token
+SNAPSHOT_PATH = os.path.join('.cache', 'canvas-{}.json')
+
+# courses only, without assignments, so inactive ones can be skipped
+COURSES_QUERY = '''
+    query GetCourses {
+        allCourses {
+            _id
+            name
+            courseCode
+            term {
+                endAt
+            }
+            account {
+                name
+            }
+        }
+    }
+'''
+
+# every course with all of its assignments, in a single query
+ASSIGNMENTS_QUERY = '''
+    query GetAssignment {
+        allCourses {
+            name
+            courseCode
+            term {
+                endAt
+            }
+            account {
+                name
+            }
+            assignmentsConnection {
+                nodes {
+                    dueAt
+                    description
+                    name
+                    unlockAt
+                    htmlUrl
+                }
+            }
+        }
+    }
+'''
+
+# one page of a single course's assignments
+ASSIGNMENTS_PAGE_QUERY = '''
+    query GetAssignmentsPage($courseId: ID!, $first: Int!, $after: String) {
+        course(id: $courseId) {
+            assignmentsConnection(first: $first, after: $after) {
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+                nodes {
+                    dueAt
+                    description
+                    name
+                    unlockAt
+                    htmlUrl
+                }
+            }
+        }
+    }
+'''
+
+
+def load_credentials(path='credentials.json'):
     '''
     Attempts to find credentials file in program args,
     if that fails it just searches in the local directory.
     Loads Canvas API token from a file. Quits app if not successful.
-
-    NOTE: function copied/pasted from trello_utility.py...
-          should probably be abstracted into generic utility function
+    The file is only parsed again if it changes.
 
     params:
-    - path: the JSON file where Trello API key/token are stored
+    - path: the JSON file where the Canvas API token is stored
 
     returns:
-    - a Python dictionary with Trello API key, token
+    - a Python dictionary with Canvas API token
     '''
 
-    # try to get file path from arguments
-    if len(sys.argv) > 1:
-        pattern = re.compile(path)
-        for arg in sys.argv[1:]:
-            if pattern.search(arg):
-                path = arg
-
-    # try to load credentials from local JSON file
-    if os.path.exists(path):
-        try:
-            f = open(path)
-            data = json.load(f)
-            token = data['canvas']['token']
-            return {'token': token}
-
-        except Exception as e:
-            print('Fatal error loading Canvas credentials: '.format(e))
-            sys.exit(1)
-
-    # file did not exist
-    else:
-        print('Fatal error: file {} does not exist'.format(path))
+    data = config_utility.load_json(path)
+    try:
+        return {'token': data['canvas']['token']}
+    except Exception as e:
+        print('Fatal error loading Canvas credentials: {}'.format(e))
         sys.exit(1)
 
 
-def _send_query(query):
+@metrics_utility.measured('canvas.query', 'http')
+def _send_query(query, variables=None, token=None):
     '''
     Send requested query and returns JSON data
     or None if an error occurred.
 
     params:
     - query: the query to send to GraphQL API via POST request
+    - variables: a dictionary of GraphQL variables used by the query
+    - token: the Canvas API token; if None, it is loaded from credentials.json
 
     returns:
     - JSON response or None
     '''
 
-    # expect bad response
-    result = None
-
     # send query
-    response = requests.post(
-        ENDPOINT.format(_load_credentials()['token']),
-        json={'query': query}
-    )
+    if token is None:
+        token = load_credentials()['token']
+    response = http_utility.post(ENDPOINT, **query_request(query, variables, token))
+
+    return query_data(response)
+
+
+def query_request(query, variables, token):
+    '''
+    Returns the headers and body of a GraphQL request (see _send_query).
+    '''
+
+    return {
+        'headers': {'Authorization': 'Bearer {}'.format(token)},
+        'json': {'query': query, 'variables': variables or {}}}
+
+
+def query_data(response):
+    '''
+    Returns the JSON data of a GraphQL response, or None if the query failed.
+    '''
 
-    # result was good!
     if response.status_code == 200:
-        result = json.loads(response.text)['data']
+        return json.loads(response.text)['data']
+    return None
+
+
+# just the ID and last change of every assignment in a course;
+# aliased once per course (see _sync_courses)
+ASSIGNMENT_VERSIONS_FIELDS = '''
+    assignmentsConnection {
+        nodes {
+            _id
+            updatedAt
+        }
+    }
+'''
+
+# everything about an assignment; aliased once per changed assignment
+ASSIGNMENT_FIELDS = '''
+    _id
+    updatedAt
+    dueAt
+    description
+    name
+    unlockAt
+    htmlUrl
+'''
+
+
+def _course_code(course):
+    '''
+    Finds the class label for Trello usage (e.g. "CSIS 420") in a course.
+
+    params:
+    - course: a course returned by the GraphQL API
+
+    returns:
+    - the course code, or None if the course doesn't have one
+    '''
+
+    code = re.search(r'\w{4} \d{3}', course['courseCode'])
+    return code[0] if code else None
+
+
+def _course_active(course, included_accounts, today_iso):
+    '''
+    Returns True if the course's term has not ended
+    and its account is one of the included accounts.
+
+    params:
+    - course: a course returned by the GraphQL API
+    - included_accounts: list of course accounts, or None for all accounts
+    - today_iso: the current date and time in ISO format
+    '''
 
+    # only add courses whose term has not ended
+    outdated = course['term']['endAt'] \
+        and course['term']['endAt'] < today_iso
+
+    # filter out courses whose account name are not specified
+    excluded = included_accounts \
+        and course['account']['name'] not in included_accounts
+
+    return not outdated and not excluded
+
+
+def _node_to_assignment(code, node, today_iso, skip=None):
+    '''
+    Converts an assignment node returned by the GraphQL API to an Assignment.
+
+    params:
+    - code: the course code of the assignment's course
+    - node: the assignment node
+    - today_iso: the current date and time in ISO format
+    - skip: a function that returns True for assignments that will be
+      thrown away anyway, or None
+
+    returns:
+    - an Assignment, or None if the assignment has no due date,
+      is still locked, or is skipped
+    '''
+
+    # parse date, skipping assignments w/o due dates
+    # and skipping assignments that are still locked
+    due = node['dueAt']
+    if not due or \
+    (node['unlockAt'] and node['unlockAt'] > today_iso):
+        return None
+
+    # the description is converted to Markdown and prefixed with the
+    # Canvas URL later, only if it is actually uploaded to Trello
+    assignment = Assignment(code, node['name'], due,
+        html=node['description'], url=node['htmlUrl'] or '')
+
+    # leave out assignments that will be thrown away
+    if skip and skip(assignment):
+        return None
+
+    return assignment
+
+
+def active_courses(courses, included_accounts, today_iso):
+    '''
+    Returns the (course code, course) pairs of the courses that have a
+    code and are active (see _course_active).
+    '''
+
+    result = []
+    for course in courses:
+        code = _course_code(course)
+        if code and _course_active(course, included_accounts, today_iso):
+            result.append((code, course))
     return result
 
 
-def get_assignments(included_accounts=None):
+def page_variables(course, page_size, cursor):
+    '''
+    Returns the variables of ASSIGNMENTS_PAGE_QUERY for the page after cursor.
     '''
-    Returns all school assignments for included accounts.
-    If query returns error, prints error message and returns empty list.
+
+    return {'courseId': course['_id'], 'first': page_size, 'after': cursor}
+
+
+def read_page(code, page, today_iso, skip=None):
+    '''
+    Reads one page of a course's assignments (see iter_assignments).
+
+    params:
+    - code: the course code
+    - page: the data of an ASSIGNMENTS_PAGE_QUERY response, or None
+    - today_iso, skip: see _node_to_assignment
+
+    returns:
+    - a tuple of the page's Assignments and the cursor of the next page,
+      which is None after the last page or an error
+    '''
+
+    if not page or not page['course']:
+        print('Error fetching assignments for {}'.format(code))
+        return ([], None)
+
+    connection = page['course']['assignmentsConnection']
+    assignments = [a for a in (_node_to_assignment(code, node, today_iso, skip)
+        for node in connection['nodes']) if a]
+
+    if not connection['pageInfo']['hasNextPage']:
+        return (assignments, None)
+    return (assignments, connection['pageInfo']['endCursor'])
+
+
+def iter_assignments(included_accounts=None, page_size=PAGE_SIZE, skip=None,
+    token=None):
+    '''
+    Yields school assignments for included accounts one at a time.
+
+    Only the course list is fetched up front; assignments are then paged
+    in page_size chunks for active courses only, so outdated and excluded
+    courses never have their assignments downloaded.
 
     params:
     - included_accounts: list of course accounts;
       if None, all assignments are returned;
       otherwise, only returns assignments whose course account name
       is in include_accounts
+    - page_size: the number of assignments to request at a time
+    - skip: a function that returns True for assignments that will be
+      thrown away anyway, or None
+    - token: the Canvas API token; if None, it is loaded from credentials.json
 
     returns:
-    - a chonky list of assignments or empty list if error occured
+    - a generator of Assignments
     '''
 
     print('Fetching assignments from Canvas')
 
-    # declare return variable
+    data = _send_query(COURSES_QUERY, token=token)
+    if not data:
+        print('Error fetching courses from Canvas')
+        return
+
+    today_iso = dt.now().isoformat()
+    for (code, course) in active_courses(data['allCourses'],
+        included_accounts, today_iso):
+
+        # page through the course's assignments
+        cursor = None
+        while True:
+            page = _send_query(ASSIGNMENTS_PAGE_QUERY,
+                page_variables(course, page_size, cursor), token)
+            assignments, cursor = read_page(code, page, today_iso, skip)
+            yield from assignments
+            if cursor is None:
+                break
+
+
+def _aliased_query(field, ids, fields):
+    '''
+    Builds a query that looks up several objects at once,
+    e.g. course(id: ...) for every ID, aliased as a0, a1, ...
+    '''
+
+    return 'query {{ {} }}'.format(' '.join(
+        'a{}: {}(id: {}) {{ {} }}'.format(i, field, json.dumps(id), fields)
+        for (i, id) in enumerate(ids)))
+
+
+def _sync_courses(courses, snapshot, token=None):
+    '''
+    Brings the snapshot up to date with the given courses, downloading only
+    the assignments that were added or changed since it was last synced.
+
+    A single query lists the ID and updatedAt of every assignment in every
+    course. A course whose assignments all still have the same updatedAt as
+    its high-water mark (the newest updatedAt seen) is skipped; otherwise
+    only its new and changed assignments are fetched, a batch at a time.
+
+    params:
+    - courses: the active courses returned by the GraphQL API
+    - snapshot: a dictionary of course ID to a dictionary with the keys
+      watermark (newest updatedAt seen) and nodes (assignment ID to
+      assignment node); updated in place
+    - token: the Canvas API token; if None, it is loaded from credentials.json
+
+    returns:
+    - False if the versions couldn't be fetched, otherwise True
+    '''
+
+    if not courses:
+        return True
+
+    versions = _send_query(_aliased_query('course',
+        [c['_id'] for c in courses], ASSIGNMENT_VERSIONS_FIELDS), token=token)
+    if not versions:
+        return False
+
+    changed = []
+    for (i, course) in enumerate(courses):
+        result = versions.get('a{}'.format(i))
+        if not result:
+            continue
+
+        nodes = result['assignmentsConnection']['nodes']
+        entry = snapshot.setdefault(course['_id'], {'watermark': '', 'nodes': {}})
+        watermark = max((n['updatedAt'] or '' for n in nodes), default='')
+
+        # nothing added, changed, or removed since the last sync
+        ids = {n['_id'] for n in nodes}
+        if ids == entry['nodes'].keys() and watermark <= entry['watermark']:
+            continue
+
+        # forget deleted assignments, fetch new and changed ones
+        for id in set(entry['nodes']) - ids:
+            del entry['nodes'][id]
+        for n in nodes:
+            old = entry['nodes'].get(n['_id'])
+            if not old or old['updatedAt'] != n['updatedAt']:
+                changed.append((entry, n['_id']))
+        entry['watermark'] = watermark
+
+    for start in range(0, len(changed), ASSIGNMENTS_PER_QUERY):
+        batch = changed[start:start + ASSIGNMENTS_PER_QUERY]
+        data = _send_query(_aliased_query('assignment',
+            [id for (_, id) in batch], ASSIGNMENT_FIELDS), token=token)
+        for (i, (entry, id)) in enumerate(batch):
+            node = data and data.get('a{}'.format(i))
+            if node:
+                entry['nodes'][id] = node
+            else:
+                # the course is checked again next time
+                entry['watermark'] = ''
+
+    print('Synced {} changed Canvas assignments'.format(len(changed)))
+    return True
+
+
+def sync_assignments(included_accounts=None, skip=None, token=None,
+    snapshot_path=None):
+    '''
+    Returns all school assignments for included accounts like
+    get_assignments, but only downloads what changed since the last call
+    (see _sync_courses). The assignments of every active course are kept
+    in a local snapshot between runs.
+
+    params:
+    - included_accounts: list of course accounts, or None for all accounts
+    - skip: a function that returns True for assignments that will be
+      thrown away anyway, or None
+    - token: the Canvas API token; if None, it is loaded from credentials.json
+    - snapshot_path: the JSON file the snapshot is kept in; defaults to
+      SNAPSHOT_PATH with a hash of the token
+
+    returns:
+    - a list of Assignments, or an empty list if an error occurred
+    '''
+
+    print('Fetching changed assignments from Canvas')
+
+    if token is None:
+        token = load_credentials()['token']
+    if snapshot_path is None:
+        snapshot_path = SNAPSHOT_PATH.format(
+            hashlib.sha1(token.encode('utf-8')).hexdigest()[:12])
+
+    snapshot = config_utility.load_json_file(snapshot_path)
+
+    data = _send_query(COURSES_QUERY, token=token)
+    if not data:
+        print('Error fetching courses from Canvas')
+        return []
+
+    today_iso = dt.now().isoformat()
+    courses = [c for c in data['allCourses'] if _course_code(c)
+        and _course_active(c, included_accounts, today_iso)]
+
+    if not _sync_courses(courses, snapshot, token):
+        print('Error fetching assignment versions from Canvas')
+        return []
+
+    # courses that ended (or were dropped) leave the snapshot
+    snapshot = {c['_id']: snapshot[c['_id']] for c in courses if c['_id'] in snapshot}
+
+    config_utility.save_json_file(snapshot_path, snapshot)
+
     assignments = []
+    for course in courses:
+        code = _course_code(course)
+        for node in snapshot.get(course['_id'], {'nodes': {}})['nodes'].values():
+            assignment = _node_to_assignment(code, node, today_iso, skip)
+            if assignment:
+                assignments.append(assignment)
+
+    return assignments
+
+
+def get_assignments(included_accounts=None, paginate=False, page_size=PAGE_SIZE,
+    skip=None, token=None, incremental=False):
+    '''
+    Returns all school assignments for included accounts.
+    If query returns error, prints error message and returns empty list.
+
+    params:
+    - included_accounts: list of course accounts;
+      if None, all assignments are returned;
+      otherwise, only returns assignments whose course account name
+      is in include_accounts
+    - paginate: if True, skip inactive courses before fetching assignments
+      and page through the rest (see iter_assignments) instead of sending
+      one query for every course
+    - page_size: the number of assignments per page when paginating
+    - skip: a function that returns True for assignments that will be
+      thrown away anyway, or None
+    - token: the Canvas API token; if None, it is loaded from credentials.json
+    - incremental: if True, only download the assignments that changed
+      since the last run (see sync_assignments)
+
+    returns:
+    - a chonky list of Assignments or empty list if error occured
+    '''
+
+    return list(stream_assignments(included_accounts, paginate, page_size,
+        skip, token, incremental))
+
+
+def stream_assignments(included_accounts=None, paginate=False,
+    page_size=PAGE_SIZE, skip=None, token=None, incremental=False):
+    '''
+    Yields all school assignments for included accounts one at a time,
+    as soon as each is converted (see get_assignments). When paginating,
+    only one page of assignments is held at a time.
+
+    params:
+    - included_accounts, paginate, page_size, skip, token, incremental:
+      see get_assignments
+
+    returns:
+    - a generator of Assignments
+    '''
+
+    if incremental:
+        yield from sync_assignments(included_accounts, skip, token)
+        return
+
+    if paginate:
+        yield from iter_assignments(included_accounts, page_size, skip, token)
+        return
+
+    print('Fetching assignments from Canvas')
 
     # GraphQL query
-    data = _send_query(
-        '''
-            query GetAssignment {
-                allCourses {
-                    name
-                    courseCode
-                    term {
-                        endAt
-                    }
-                    account {
-                        name
-                    }
-                    assignmentsConnection {
-                        nodes {
-                            dueAt
-                            description
-                            name
-                            unlockAt
-                            htmlUrl
-                        }
-                    }
-                }
-            }
-        '''
-    )
+    data = _send_query(ASSIGNMENTS_QUERY, token=token)
+    if not data:
+        print('Error fetching assignments from Canvas')
+        return
 
     # errors cause no assignments to be returned
     if 'errors' in data.keys():
         for e in data['errors']:
             print(e['message'])
-        return assignments
+        return
+
+    yield from iter_courses_assignments(data['allCourses'], included_accounts, skip)
+
+
+def iter_courses_assignments(courses, included_accounts=None, skip=None):
+    '''
+    Converts the assignments of the courses returned by ASSIGNMENTS_QUERY,
+    leaving out courses that aren't active (see _course_active).
+
+    params:
+    - courses: the allCourses list returned by the GraphQL API
+    - included_accounts: list of course accounts, or None for all accounts
+    - skip: a function that returns True for assignments that will be
+      thrown away anyway, or None
+
+    returns:
+    - a generator of Assignments
+    '''
 
     # loop through all courses...
     today_iso = dt.now().isoformat()
-    for course in data['allCourses']:
+    for course in courses:
 
         # add class label for Trello usage;
         # if class has no course code, skip it
-        code = re.search(r'\w{4} \d{3}', course['courseCode'])
-        if code:
-            code = code[0]
-        else:
+        code = _course_code(course)
+        if not code:
             # print('Error: no course code found for class {}'.format(course['name']))
             continue
 
-        # only add courses whose term has not ended
-        outdated = course['term']['endAt'] \
-            and course['term']['endAt'] < today_iso
-
-        # filter out courses whose account name are not specified
-        excluded = included_accounts \
-            and course['account']['name'] not in included_accounts
-
-        if not outdated and not excluded:
-
-            for a in course['assignmentsConnection']['nodes']:
-
-                # parse date, skipping assignments w/o due dates
-                # and skipping assignments that are still locked
-                due = a['dueAt']
-                if not due or \
-                (a['unlockAt'] and a['unlockAt'] > today_iso):
-                    continue
-
-                # convert description from HTML to markdown
-                if a['description']:
-                    description = markdownify.markdownify(a['description']).strip()
-                else:
-                    description = ''
-
-                # add assignment Canvas URL to assignment description
-                if a['htmlUrl']:
-                    description = '{}\n\n{}'.format(a['htmlUrl'], description)
-
-                assignments.append({
-                    'class': code,
-                    'due': due,
-                    'title': a['name'],
-                    'description': description}
-                )
-
-    return assignments
+        if _course_active(course, included_accounts, today_iso):
+            for node in course['assignmentsConnection']['nodes']:
+                assignment = _node_to_assignment(code, node, today_iso, skip)
+                if assignment:
+                    yield assignment
 
 
 if __name__ == '__main__':
     data = get_assignments(included_accounts=['Undergrad Programs'])
     if data:
+        data = [a.to_dict(render=True) for a in data]
         print(f'Data received from Canvas:\n{json.dumps(data, indent=2)}')
     else:
         print('No data found ¯\_(ツ)_/¯')
\ No newline at end of file
@@ -0,0 +1,107 @@
+'''
+Checks that gfu_utility parses the saved course pages in fixtures/sites
+exactly the same as when the golden files in fixtures/golden were recorded.
+
+Run with:
+
+    python check_golden.py [--update]
+
+Every page is checked with the default parser backend and, if installed,
+with lxml. --update re-records the golden files from the default backend;
+only use it when a change in output is intended.
+'''
+
+import json, os, sys
+import gfu_utility
+
+
+SITES_DIR = os.path.join('fixtures', 'sites')
+GOLDEN_DIR = os.path.join('fixtures', 'golden')
+
+# golden files are recorded for a fixed year so they don't go stale
+YEAR = 2020
+
+
+def _parsers():
+    '''
+    Returns the parser backends that are installed.
+    '''
+
+    parsers = [gfu_utility.PARSER]
+    try:
+        import lxml
+        parsers.append('lxml')
+    except ImportError:
+        print('lxml not installed, only checking {}'.format(gfu_utility.PARSER))
+    return parsers
+
+
+def _class_name(filename):
+    '''
+    Turns a fixture file name like csis-420.html into a class name
+    like CSIS 420.
+    '''
+
+    return os.path.splitext(filename)[0].replace('-', ' ').upper()
+
+
+def _parse(filename, html, parser=None):
+    '''
+    Parses a saved course page the way an upload would see it,
+    i.e. with every description rendered to Markdown.
+    '''
+
+    assignments = gfu_utility.parse_site_assignments(
+        _class_name(filename), html, year=YEAR, parser=parser)
+    return [a.to_dict(render=True) for a in assignments]
+
+
+def check(update=False):
+    '''
+    Parses every saved course page and compares the result to its golden file.
+
+    params:
+    - update: write the current output as the new golden files instead
+
+    returns:
+    - the number of pages whose output differed from the golden file
+    '''
+
+    failures = 0
+    for filename in sorted(os.listdir(SITES_DIR)):
+        with open(os.path.join(SITES_DIR, filename), encoding='utf-8') as f:
+            html = f.read()
+        golden_path = os.path.join(GOLDEN_DIR,
+            os.path.splitext(filename)[0] + '.json')
+
+        if update:
+            result = _parse(filename, html)
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            with open(golden_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2, ensure_ascii=False)
+                f.write('\n')
+            print('Recorded {}'.format(golden_path))
+            continue
+
+        with open(golden_path, encoding='utf-8') as f:
+            expected = json.load(f)
+
+        for parser in _parsers():
+            result = _parse(filename, html, parser)
+            if result == expected:
+                print('ok\t{}\t{}'.format(parser, filename))
+                continue
+
+            failures += 1
+            print('FAIL\t{}\t{}'.format(parser, filename))
+            for (i, (got, want)) in enumerate(zip(result, expected)):
+                if got != want:
+                    print('  row {}:\n    got  {}\n    want {}'.format(i, got, want))
+            if len(result) != len(expected):
+                print('  got {} rows, want {}'.format(len(result), len(expected)))
+
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if check(update='--update' in sys.argv[1:]) else 0)
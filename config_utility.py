@@ -0,0 +1,149 @@
+'''
+Loads the program's JSON files (credentials, site info, Trello info).
+
+Each file is parsed once per process and only read again if its
+modification time changes, so long-running modes see edits without paying
+for a parse on every request. The JSON files the program keeps for itself
+(caches and snapshots) are read and written with load_json_file and
+save_json_file.
+'''
+
+from functools import lru_cache
+from threading import Lock
+import json, sys, re, os.path
+
+
+_cache = {}
+_lock = Lock()
+
+
+@lru_cache(maxsize=None)
+def _find_in_args(path, args):
+    pattern = re.compile(path)
+    for arg in args:
+        if pattern.search(arg):
+            path = arg
+    return path
+
+
+def find_path(path):
+    '''
+    Attempts to find a file path in program args,
+    if that fails the path is returned as is (i.e. in the local directory).
+
+    params:
+    - path: the default file name, e.g. credentials.json
+
+    returns:
+    - the last program arg matching path, or path itself
+    '''
+
+    return _find_in_args(path, tuple(sys.argv[1:]))
+
+
+def load_json(path, label=None):
+    '''
+    Finds a JSON file (see find_path) and returns its contents,
+    parsing it only the first time or when it has changed on disk.
+    Quits the program if the file doesn't exist or can't be parsed.
+
+    params:
+    - path: the default file name, e.g. credentials.json
+    - label: if given, prints "<label> loaded from <path>" whenever
+      the file is (re)loaded
+
+    returns:
+    - the parsed JSON data; callers must not modify it
+    '''
+
+    path = find_path(path)
+
+    # file did not exist
+    if not os.path.exists(path):
+        print('Fatal error: file {} does not exist'.format(path))
+        sys.exit(1)
+
+    try:
+        key = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        with _lock:
+            cached = _cache.get(key)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+            with open(path) as f:
+                data = json.load(f)
+            _cache[key] = (mtime, data)
+
+    # I/O error of some kind
+    except Exception as e:
+        print('Fatal error loading {}: {}'.format(path, e))
+        sys.exit(1)
+
+    if label:
+        print('{} loaded from {}'.format(label, path))
+    return data
+
+
+def load_json_file(path, default=None):
+    '''
+    Reads a JSON file the program keeps for itself, e.g. a cache.
+    A missing or corrupt file is the same as an empty one.
+
+    params:
+    - path: the JSON file
+    - default: returned if the file is missing or unreadable;
+      an empty dictionary if None
+
+    returns:
+    - the parsed JSON data, or default
+    '''
+
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except Exception as e:
+            print('Ignoring unreadable {}: {}'.format(path, e))
+    return {} if default is None else default
+
+
+def save_json_file(path, data, indent=None):
+    '''
+    Writes a JSON file the program keeps for itself, creating its
+    directory if needed.
+
+    params:
+    - path: the JSON file
+    - data: the data to write
+    - indent: passed on to json.dump
+    '''
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=indent)
+
+
+def option(name, default=None):
+    '''
+    Looks up an optional program arg that can carry a value,
+    e.g. --trace or --trace=run.json.
+
+    params:
+    - name: the option, e.g. --trace
+    - default: the value used when the option is given without one
+
+    returns:
+    - the option's value, default if it has none,
+      or None if the option wasn't given
+    '''
+
+    result = None
+    for arg in sys.argv[1:]:
+        if arg == name:
+            result = default
+        elif arg.startswith(name + '='):
+            result = arg[len(name) + 1:]
+    return result
@@ -0,0 +1,102 @@
+'''
+Scheduling for the long-running daemon mode (see main.run_daemon).
+
+Every source is polled on its own schedule. A source that keeps coming back
+unchanged is polled less and less often, up to a maximum interval, and every
+interval is jittered so many instances started at the same time drift apart
+instead of hitting the same server together.
+'''
+
+import random, time
+
+
+# (base interval, max interval) in seconds for each source
+INTERVALS = {
+    'Trello': (5 * 60, 60 * 60),
+    'CS sites': (15 * 60, 6 * 60 * 60),
+    'Canvas': (10 * 60, 2 * 60 * 60),
+}
+
+# fraction of an interval that each wait is randomly shifted by
+JITTER = 0.2
+
+# longest single sleep, so Ctrl+C and clock changes are noticed quickly
+MAX_SLEEP = 60
+
+
+class SourceSchedule:
+    '''
+    When a single source should next be polled.
+    '''
+
+    def __init__(self, name, interval, max_interval, jitter=JITTER):
+        '''
+        params:
+        - name: the source's name, for printing
+        - interval: seconds between polls while the source keeps changing
+        - max_interval: the longest the interval backs off to
+        - jitter: fraction of the interval each wait is randomly shifted by
+        '''
+
+        self.name = name
+        self.interval = interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.current = interval
+
+        # spread out the first poll of instances started together
+        self.next_run = time.time() + random.uniform(0, jitter * interval)
+
+    def due(self, now):
+        return now >= self.next_run
+
+    def done(self, changed, now):
+        '''
+        Schedules the next poll after one has finished.
+
+        params:
+        - changed: whether the poll found anything new; if so the interval
+          resets, otherwise it doubles up to max_interval
+        - now: the current time
+        '''
+
+        if changed:
+            self.current = self.interval
+        else:
+            self.current = min(self.current * 2, self.max_interval)
+
+        wait = self.current * (1 + random.uniform(-self.jitter, self.jitter))
+        self.next_run = now + wait
+
+
+def run(jobs):
+    '''
+    Polls sources forever until interrupted.
+
+    params:
+    - jobs: a list of (SourceSchedule, function) pairs; each function polls
+      its source and returns True if it found anything new. An exception
+      counts as no change so one failing source doesn't stop the others.
+
+    returns:
+    - none
+    '''
+
+    try:
+        while True:
+            for (schedule, poll) in jobs:
+                if schedule.due(time.time()):
+                    try:
+                        changed = poll()
+                    except Exception as e:
+                        print('Error polling {}: {}'.format(schedule.name, e))
+                        changed = False
+                    schedule.done(changed, time.time())
+                    print('Next {} poll in {:.0f}s'.format(
+                        schedule.name, schedule.next_run - time.time()))
+
+            next_run = min(schedule.next_run for (schedule, _) in jobs)
+            time.sleep(min(MAX_SLEEP, max(0, next_run - time.time())))
+
+    except KeyboardInterrupt:
+        print('Stopping daemon')
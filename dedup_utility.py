@@ -0,0 +1,104 @@
+'''
+Hash-indexed lookup of assignments that are already on Trello.
+
+Assignments are keyed on their normalized (class, title) pair so that
+checking whether a scraped assignment is new costs O(1) instead of a scan
+over every Trello card.
+'''
+
+from datetime import date, datetime, time
+import re
+
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_key(class_name, title):
+    '''
+    Builds the dedup key for an assignment.
+
+    params:
+    - class_name: the class code of the assignment (e.g. "CSIS 420")
+    - title: the assignment title
+
+    returns:
+    - a tuple of the case-folded, whitespace-collapsed class and title
+    '''
+
+    return (
+        _WHITESPACE.sub(' ', class_name or '').strip().casefold(),
+        _WHITESPACE.sub(' ', title or '').strip().casefold())
+
+
+class AssignmentIndex:
+    '''
+    Set of (class, title) keys for assignments that are already known,
+    plus the due date cutoff that scraped assignments must beat.
+
+    The index is built once from the Trello cards and can be extended
+    as assignments get uploaded, so later passes (e.g. Canvas after the
+    CS sites) see what earlier passes added.
+    '''
+
+    def __init__(self, assignments=(), today=None):
+        '''
+        params:
+        - assignments: assignments already on Trello
+        - today: new assignments must be due on or after this date;
+          defaults to today's date
+        '''
+
+        self.cutoff = datetime.combine(today or date.today(), time.min)
+        self._keys = set()
+        self.extend(assignments)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, assignment):
+        return assignment.key in self._keys
+
+    def add(self, assignment):
+        '''
+        Marks a single assignment as known.
+        '''
+
+        self._keys.add(assignment.key)
+
+    def extend(self, assignments):
+        '''
+        Marks every assignment in an iterable as known.
+        '''
+
+        for a in assignments:
+            self.add(a)
+
+    def is_upcoming(self, assignment):
+        '''
+        Returns True if the assignment is due on or after the cutoff.
+        '''
+
+        return assignment.due_at >= self.cutoff
+
+    def is_past(self, assignment):
+        '''
+        Returns True if the assignment is due before the cutoff. Unlike a
+        lambda, the bound method can be sent to a worker process.
+        '''
+
+        return assignment.due_at < self.cutoff
+
+    def is_new(self, assignment):
+        '''
+        Returns True if the assignment is upcoming and not already known.
+        '''
+
+        return self.is_upcoming(assignment) and assignment not in self
+
+    def filter_new(self, assignments):
+        '''
+        Returns the assignments that are upcoming and not already known,
+        in their original order.
+        '''
+
+        return [a for a in assignments if self.is_new(a)]
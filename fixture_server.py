@@ -0,0 +1,310 @@
+'''
+Local stand-in for the GFU course sites, Canvas, and Trello, serving the
+recorded responses in fixtures/ so the scraper can be benchmarked without
+touching the live servers.
+
+Every response can be scaled up: course pages get their assignment rows
+repeated, and Canvas courses and Trello cards are copied (with unique
+names and IDs) `scale` times.
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import RLock, Thread
+from urllib.parse import parse_qs, urlsplit
+import copy, json, os, re, time
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+_ROW = re.compile(r'<tr>\s*<td>.*?</tr>\s*', re.DOTALL)
+
+# the lists of the recorded board, which the recorded cards are in
+LISTS = [
+    ('Today', '5f60cc60cc639973d1335ede'),
+    ('This Week', '5f60cc5e9e15a575fa723405'),
+    ('To-Do', '5f60cc5ab8b90f19b7739b14'),
+    ('Done', '5fa0acbf1e3c9a1e5cbe7f10')]
+
+
+def _load(*path):
+    with open(os.path.join(FIXTURES, *path), encoding='utf-8') as f:
+        return f.read()
+
+
+def _query(path, name):
+    values = parse_qs(urlsplit(path).query).get(name)
+    return values[0] if values else None
+
+
+def scale_site(html, scale):
+    '''
+    Repeats every table row of a course page so it lists `scale` times
+    as many assignments.
+    '''
+
+    if scale <= 1:
+        return html
+    rows = ''.join(_ROW.findall(html))
+    end = html.rindex('</table>')
+    return html[:end] + rows * (scale - 1) + html[end:]
+
+
+def scale_courses(data, scale):
+    '''
+    Copies every course in an allCourses response `scale` times; copies get
+    their own IDs and assignment names so they don't dedup against each other.
+    '''
+
+    courses = []
+    for i in range(scale):
+        for course in data['data']['allCourses']:
+            course = copy.deepcopy(course)
+            if i:
+                course['_id'] = '{}-{}'.format(course['_id'], i)
+                for node in course['assignmentsConnection']['nodes']:
+                    node['_id'] = '{}-{}'.format(node['_id'], i)
+                    node['name'] = '{} ({})'.format(node['name'], i)
+            courses.append(course)
+    return {'data': {'allCourses': courses}}
+
+
+def scale_cards(cards, scale):
+    '''
+    Copies the recorded cards `scale` times; copies stay in their card's list.
+    '''
+
+    result = []
+    for i in range(scale):
+        for card in cards:
+            card = dict(card)
+            card['id'] = '{}{:04x}{}'.format(card['id'][:16], i, card['id'][-4:])
+            if i:
+                card['name'] = '{} ({})'.format(card['name'], i)
+            result.append(card)
+    return result
+
+
+def project_cards(cards, fields):
+    '''
+    Keeps only the requested comma-separated fields (and the ID) of every
+    card, like Trello's `fields` parameter; None or "all" keeps everything.
+    '''
+
+    if fields in (None, 'all'):
+        return cards
+    keep = ['id'] + fields.split(',')
+    return [{k: card[k] for k in keep if k in card} for card in cards]
+
+
+class FixtureServer:
+    '''
+    Threaded HTTP server on localhost answering with the recorded fixtures.
+
+    Routes:
+    - GET /sites/<name>.html: fixtures/sites/<name>.html
+    - POST /api/graphql: Canvas allCourses, paged course(id), and aliased
+      course(id)/assignment(id) queries
+    - GET /1/boards/<id>/labels,
+      GET /1/boards/<id>/actions (always none), GET /1/boards/<id>/cards,
+      GET /1/lists/<id>/cards (both honour `fields`),
+      POST /1/labels, POST /1/cards: Trello; cards with a label that
+      isn't in labels are refused like Trello does
+
+    Counts the requests and bytes served, and when the first card was
+    created (a time.perf_counter() value in first_card), since the last
+    reset_counters().
+    '''
+
+    def __init__(self, scale=1):
+        '''
+        params:
+        - scale: how many times to multiply the recorded data
+        '''
+
+        self.scale = scale
+        self.requests = 0
+        self.bytes_sent = 0
+        self.first_card = None
+        self._lock = RLock()
+        self._courses = json.loads(_load('canvas', 'all-courses.json'))
+        self._cards = json.loads(_load('trello', 'cards.json'))
+        self.labels = json.loads(_load('trello', 'labels.json'))
+        self._scaled = {}
+        self._created = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive like the real servers; without TCP_NODELAY every
+            # response waits out the client's delayed ACK (~40ms)
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server._handle(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                server._handle(self, self.rfile.read(length))
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.first_card = None
+
+    def _cached(self, key, make):
+        # scaled responses are built once per scale, outside the timed requests;
+        # make() may itself use the cache, hence the RLock
+        key = (key, self.scale)
+        with self._lock:
+            if key not in self._scaled:
+                self._scaled[key] = make()
+            return self._scaled[key]
+
+    def _handle(self, handler, body):
+        path = handler.path.split('?')[0]
+        status, data = 200, None
+
+        site = re.fullmatch(r'/sites/([\w-]+)\.html', path)
+        cards = re.fullmatch(r'/1/(lists|boards)/(\w+)/cards', path)
+
+        if site:
+            name = site[1]
+            if not os.path.exists(os.path.join(FIXTURES, 'sites', name + '.html')):
+                status = 404
+            else:
+                data = self._cached(path, lambda: scale_site(
+                    _load('sites', name + '.html'), self.scale).encode('utf-8'))
+
+        elif path == '/api/graphql':
+            data = self._graphql(json.loads(body))
+
+        elif cards:
+            data = self._cached(handler.path, lambda: self._cards_json(
+                handler.path, cards[1], cards[2]))
+
+        elif re.fullmatch(r'/1/boards/\w+/labels', path):
+            data = json.dumps(self.labels).encode('utf-8')
+
+        elif path == '/1/labels' and body is not None:
+            with self._lock:
+                self._created += 1
+                label = {'id': '{:024x}'.format(self._created),
+                    'name': _query(handler.path, 'name')}
+                self.labels.append(label)
+            data = json.dumps(label).encode('utf-8')
+
+        elif re.fullmatch(r'/1/boards/\w+/actions', path):
+            data = b'[]'
+
+        elif path == '/1/cards' and body is not None \
+        and _query(handler.path, 'idLabels') not in [l['id'] for l in self.labels]:
+            status, data = 400, b'invalid value for idLabels'
+
+        elif path == '/1/cards' and body is not None:
+            with self._lock:
+                self._created += 1
+                card_id = '{:024x}'.format(self._created)
+                if self.first_card is None:
+                    self.first_card = time.perf_counter()
+            data = json.dumps({'id': card_id}).encode('utf-8')
+
+        else:
+            status = 404
+
+        # counted before answering, so the client never sees it uncounted
+        data = data or b''
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += len(data)
+
+        handler.send_response(status)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _cards_json(self, path, parent, id):
+        board = self._cached('cards', lambda: scale_cards(self._cards, self.scale))
+        if parent == 'lists':
+            board = [c for c in board if c['idList'] == id]
+        if _query(path, 'filter') != 'all':
+            board = [c for c in board if not c['closed']]
+        return json.dumps(project_cards(board, _query(path, 'fields'))).encode('utf-8')
+
+    def _graphql(self, request):
+        courses = self._cached('allCourses', lambda: scale_courses(
+            self._courses, self.scale))
+
+        # several courses or assignments looked up at once by alias
+        aliases = re.findall(r'(\w+): (course|assignment)\(id: "([^"]+)"\)',
+            request['query'])
+        if aliases:
+            by_id = {}
+            for course in courses['data']['allCourses']:
+                by_id[('course', course['_id'])] = course
+                for node in course['assignmentsConnection']['nodes']:
+                    by_id[('assignment', node['_id'])] = node
+
+            data = {}
+            for (alias, field, id) in aliases:
+                found = by_id.get((field, id))
+                if found and field == 'course':
+                    found = {'assignmentsConnection': {'nodes': [
+                        {'_id': n['_id'], 'updatedAt': n['updatedAt']}
+                        for n in found['assignmentsConnection']['nodes']]}}
+                data[alias] = found
+            return json.dumps({'data': data}).encode('utf-8')
+
+        # one page of a single course's assignments
+        if 'course(id' in request['query']:
+            variables = request['variables']
+            course = next((c for c in courses['data']['allCourses']
+                if c['_id'] == variables['courseId']), None)
+            if not course:
+                return json.dumps({'data': {'course': None}}).encode('utf-8')
+
+            nodes = course['assignmentsConnection']['nodes']
+            start = int(variables.get('after') or 0)
+            end = start + variables['first']
+            return json.dumps({'data': {'course': {'assignmentsConnection': {
+                'pageInfo': {'hasNextPage': end < len(nodes), 'endCursor': str(end)},
+                'nodes': nodes[start:end]}}}}).encode('utf-8')
+
+        # like Canvas, only send assignments if the query asks for them
+        if 'assignmentsConnection' not in request['query']:
+            return self._cached('allCourses-only.json', lambda: json.dumps(
+                {'data': {'allCourses': [
+                    {k: v for (k, v) in c.items() if k != 'assignmentsConnection'}
+                    for c in courses['data']['allCourses']]}}).encode('utf-8'))
+
+        return self._cached('allCourses.json',
+            lambda: json.dumps(courses).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    server = FixtureServer()
+    print('Serving fixtures on {} (Ctrl+C to stop)'.format(server.url))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
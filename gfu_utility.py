@@ -1,9 +1,24 @@
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
-import requests, re, json, sys, os.path, markdownify
+from assignment_utility import Assignment
+from cache_utility import HttpCache
+import config_utility, http_utility, metrics_utility, re, json, os, pickle, sys
 
 
-def _load_sites_info(path='site-info.json'):
+# default number of course sites downloaded at once
+MAX_WORKERS = 8
+
+# default seconds to wait on a single course site
+TIMEOUT = 10
+
+# BeautifulSoup parser backend; 'lxml' is about twice as fast but repairs
+# malformed tables differently, so it is opt-in (--lxml)
+PARSER = 'html.parser'
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def load_sites_info(path='site-info.json'):
     '''
     Attempts to find site info file in program args,
     if that fails it just searches in the local directory.
@@ -17,29 +32,7 @@ def _load_sites_info(path='site-info.json'):
     - a python dict of site information
     '''
 
-    # try to get file path from arguments
-    if len(sys.argv) > 1:
-        pattern = re.compile(path)
-        for arg in sys.argv[1:]:
-            if pattern.search(arg):
-                path = arg
-
-    # load data from file if it exists
-    if os.path.exists(path):
-        try:
-            f = open(path)
-            print('Assignment page info loaded from {}'.format(path))
-            return json.load(f)
-
-        # I/O error of some kind
-        except Exception as e:
-            print('Fatal error: '.format(e))
-            sys.exit(1)
-
-    # file did not exist
-    else:
-        print('Fatal error: file {} does not exist'.format(path))
-        sys.exit(1)
+    return config_utility.load_json(path, 'Assignment page info')
 
 
 def _find_title(td):
@@ -53,24 +46,53 @@ def _find_title(td):
       for which a title is desired
 
     returns:
-    - a string representation of the assignment title if <em> is first child,
-      otherwise None
+    - a string representation of the assignment title if <em> is first child
+      and has text, otherwise None
     '''
 
     result = None
 
-    # if first tag within <td> is <em>
+    # if first tag within <td> is <em> (and it isn't empty)
     if len(td.contents) > 0 and td.contents[0].name == 'em':
-        result = list(td.em.stripped_strings)[0]
-        result = re.sub(r'&', 'and', result)
-        result = re.sub(r'\s+', ' ', result)
+        result = next(td.em.stripped_strings, None)
+        if result is not None:
+            result = _WHITESPACE.sub(' ', result.replace('&', 'and'))
 
     return result
 
 
-def _get_site_assignments(class_name, site_info):
+@metrics_utility.measured('gfu.fetch', 'http')
+def _fetch_site(class_name, site_info, timeout=TIMEOUT, cache=None):
+    '''
+    Downloads the assignments page of a single class.
+
+    params:
+    - class_name: the name of this class
+    - site_info: the information about this assignment page (see README)
+    - timeout: seconds to wait for the server before giving up
+    - cache: an HttpCache to send a conditional request through, or None
+
+    returns:
+    - a tuple (html, entry) as returned by HttpCache.get;
+      without a cache, entry is always None
+    '''
+
+    print('Fetching assignments for {} from {}'.format(class_name, site_info['url']))
+
+    # not retried, so one slow site takes at most the timeout
+    if cache:
+        return cache.get(site_info['url'], site_info['headers'], timeout,
+            retry=False)
+
+    response = http_utility.get(site_info['url'], headers=site_info['headers'],
+        timeout=timeout, retry=False)
+    return (response.text, None)
+
+
+@metrics_utility.measured('gfu.parse', 'parse')
+def parse_site_assignments(class_name, html, year=None, parser=None, skip=None):
     '''
-    Parses the specified webpage for school assignments.
+    Parses the HTML of an assignments page for school assignments.
     The page must be formatted such that assignments are
     described in rows of an HTML table. Each table row must have
     the following attributes:
@@ -88,38 +110,43 @@ def _get_site_assignments(class_name, site_info):
 
     params:
     - class_name: the name of this class
-    - site_info: the information about this assignment page (see README)
+    - html: the HTML of the assignments page
+    - year: the year assignments are due in; defaults to the current year
+    - parser: the BeautifulSoup parser backend; defaults to PARSER
+    - skip: a function that is given the Assignment made from a row
+      (without its description) and returns True if it will be thrown
+      away anyway, in which case it is left out
 
     returns:
-    - a list of dictionaries that hold the following keys:
-      - class
-      - due
-      - title
-      - description
+    - a list of Assignments, whose descriptions are only converted
+      to Markdown when first read
     '''
 
-    print('Parsing assignments for {} from {}'.format(class_name, site_info['url']))
+    # bs4 is slow to import and not needed at all when every page is cached
+    from bs4 import BeautifulSoup, SoupStrainer
 
-    # grab HTML and make it into beautiful soup 🍲
-    response = requests.get(site_info['url'], headers=site_info['headers'])
-    soup = BeautifulSoup(response.text, 'html.parser')
+    # make the table rows of the HTML into beautiful soup 🍲
+    soup = BeautifulSoup(html, parser or PARSER, parse_only=SoupStrainer('tr'))
 
     # store assignments found in HTML into list
     assignments = []
+    count = 0
     for row in soup('tr'):
 
         # assignments always have three columns
         # and assignements always have m/d date format
         cols = row('td')
-        if len(cols) == 3 and re.search(r'/', cols[0].string):
+        if len(cols) == 3 and '/' in cols[0].string:
 
-            # assignment due dates are always column 2/3
-            due_text = re.sub(r"'", "", repr(cols[1].contents[0]))
-            due = tuple(re.split(r'/', due_text))
+            # assignment due dates are always column 2/3;
+            # the date goes through repr() like it always has, so dates
+            # with escaped characters (e.g. "1/15\n") still fail to parse
+            due_text = repr(str(cols[1].contents[0])).replace("'", '')
+            due = due_text.split('/')
             try:
                 due_month = int(due[0])
                 due_day = int(due[1])
-                due = datetime(datetime.today().year, \
+                due = datetime(year or datetime.today().year, \
                     due_month, due_day, 23, 59).isoformat()
 
             # if date parsing failed, this assignment has no due date listed
@@ -130,58 +157,320 @@ def _get_site_assignments(class_name, site_info):
 
             # if an <em> tag exists at beginning of table data contents,
             # use it for the assignment title, otherwise use "Assignment #"
+            count += 1
             title = _find_title(cols[2])
             if not title:
-                title = "Assignment {}".format(len(assignments) + 1)
+                title = "Assignment {}".format(count)
 
-            # remove <td> tags from description,
-            # then convert to Markdown so formatting is preserved in Trello
-            description = markdownify.markdownify(re.sub(r'<td>', '', repr(cols[2])))
+            # leave out rows that will be thrown away
+            # (they still count towards the "Assignment #" numbering)
+            assignment = Assignment(class_name, title, due)
+            if skip and skip(assignment):
+                continue
 
-            # append assignment dictionary
-            assignments.append({
-                'class': class_name,
-                'due': due,
-                'title': title,
-                'description':description})
+            # remove <td> tags from description; it is converted to
+            # Markdown later, only if it is actually uploaded to Trello
+            assignment.html = str(cols[2]).replace('<td>', '')
+
+            assignments.append(assignment)
 
     return assignments
 
 
-def get_assignments():
+def _parse_site_tuples(class_name, html, year=None, parser=None, skip=None):
+    '''
+    Parses an assignments page in a worker process (see
+    parse_site_assignments), returning only what is needed to rebuild the
+    assignments so as little as possible is sent back to the parent.
+
+    returns:
+    - a list of (title, due, description HTML) tuples
+    '''
+
+    return [(a.title, a.due, a.html) for a in
+        parse_site_assignments(class_name, html, year, parser, skip)]
+
+
+def _get_site_assignments(class_name, site_info, timeout=TIMEOUT):
+    '''
+    Downloads and parses the assignments page of a single class.
+    See parse_site_assignments for the expected page format.
+
+    params:
+    - class_name: the name of this class
+    - site_info: the information about this assignment page (see README)
+    - timeout: seconds to wait for the server before giving up
+
+    returns:
+    - a list of Assignments
+    '''
+
+    html, _ = _fetch_site(class_name, site_info, timeout)
+    return parse_site_assignments(class_name, html)
+
+
+def site_options(use_cache=None, parser=None):
+    '''
+    Fills in the page cache and parser backend options from the program
+    args (see iter_sites_assignments).
+
+    returns:
+    - a tuple of the HttpCache to use (or None) and the parser backend
+    '''
+
+    if use_cache is None:
+        use_cache = '--no-cache' not in sys.argv[1:]
+    if parser is None:
+        parser = 'lxml' if '--lxml' in sys.argv[1:] else PARSER
+    return (HttpCache() if use_cache else None, parser)
+
+
+def group_sites(sites):
     '''
-    Gets all assignments from all sites in site_info.
+    Groups sites by URL, so each page is fetched once with the headers of
+    the first site listing it and then parsed once for every class name
+    it is listed under.
 
     params:
-    - none
+    - sites: a list of (class name, site info) pairs
 
     returns:
-    - a list of dictionaries where each dictionary holds the info
-      for a single school assignment
+    - a dictionary of URL to (site info, list of class names)
+    '''
+
+    urls = {}
+    for (class_name, site_info) in sites:
+        _, class_names = urls.setdefault(site_info['url'], (site_info, []))
+        if class_name not in class_names:
+            class_names.append(class_name)
+    return urls
+
+
+def cached_assignments(entry, class_names):
+    '''
+    Returns the cached assignments of a page that hasn't changed since
+    the last run, as (class name, list of Assignments) pairs.
+    '''
+
+    print('{} unchanged, using cached assignments'.format(class_names[0]))
+    return [(class_name, [
+        Assignment.from_dict(dict(a, **{'class': class_name}))
+        for a in entry['assignments']])
+        for class_name in class_names]
+
+
+def cache_parsed(cache, url, entry, assignments):
+    '''
+    Caches what was parsed from a changed page under its first class name
+    (nothing if entry is None).
+    '''
+
+    if entry is not None:
+        entry['assignments'] = [a.to_dict() for a in assignments]
+        cache.put(url, entry)
+
+
+def iter_sites_assignments(sites, max_workers=MAX_WORKERS, timeout=TIMEOUT,
+    use_cache=None, parser=None, skip=None, processes=None):
+    '''
+    Yields the assignments of a list of course sites one page at a time,
+    as soon as each page has been downloaded and parsed, so the first
+    assignments can be used while the other sites are still downloading.
+    Each distinct URL is downloaded only once, even if several sites
+    (e.g. the same class in several students' site info) share it;
+    a site that fails or times out only loses that class's assignments.
+    Pages that haven't changed since the last run are not parsed again.
+
+    params:
+    - sites: a list of (class name, site info) pairs
+    - max_workers: the most course sites to download at once;
+      1 downloads them one at a time
+    - timeout: seconds to wait on any single course site
+    - use_cache: whether to use the on-disk page cache;
+      if None, the cache is used unless --no-cache is in program args
+    - parser: the BeautifulSoup parser backend; if None, lxml is used
+      when --lxml is in program args, otherwise PARSER
+    - skip: a function that returns True for assignments that will be
+      thrown away anyway; it must only skip assignments that will never
+      be wanted later, because pages are cached without them
+    - processes: the number of worker processes pages are parsed in, so
+      parsing many pages isn't limited to one core; 0 parses them in this
+      process. If None, --processes[=N] in program args sets it
+      (N defaults to the number of CPUs), otherwise 0
+
+    returns:
+    - a generator of (class name, URL, list of Assignments) tuples,
+      in the order the pages finish
+    '''
+
+    cache, parser = site_options(use_cache, parser)
+    if processes is None:
+        processes = int(config_utility.option('--processes', os.cpu_count()) or 0)
+
+    # workers get the skip function too if it can be pickled (e.g. a bound
+    # method), otherwise assignments are skipped once they come back
+    workers = ProcessPoolExecutor(processes) if processes else None
+    worker_skip = skip
+    if workers and skip:
+        try:
+            pickle.dumps(skip)
+        except Exception:
+            worker_skip = None
+
+    urls = group_sites(sites)
+    def cache_first(class_name, url, entry, assignments):
+        if class_name == urls[url][1][0]:
+            cache_parsed(cache, url, entry, assignments)
+
+    parsing = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            futures = {
+                pool.submit(metrics_utility.bind(_fetch_site),
+                    class_names[0], site_info, timeout, cache): url
+                for (url, (site_info, class_names)) in urls.items()}
+
+            # parse each page as soon as it has downloaded
+            for future in as_completed(futures):
+                url = futures[future]
+                class_names = urls[url][1]
+                parsed = []
+                try:
+                    html, entry = future.result()
+
+                    # page unchanged since last run
+                    if html is None:
+                        parsed = cached_assignments(entry, class_names)
+
+                    # hand the page to a worker process, or parse it right away
+                    else:
+                        for class_name in class_names:
+                            if workers:
+                                parsing[workers.submit(_parse_site_tuples,
+                                    class_name, html, None, parser, worker_skip)] = \
+                                    (class_name, url, entry)
+                            else:
+                                assignments = parse_site_assignments( \
+                                    class_name, html, parser=parser, skip=skip)
+                                cache_first(class_name, url, entry, assignments)
+                                parsed.append((class_name, assignments))
+
+                except Exception as e:
+                    print(f'Error parsing {class_names[0]}')
+
+                for (class_name, assignments) in parsed:
+                    yield (class_name, url, assignments)
+
+        # rebuild the assignments parsed by the worker processes
+        for future in as_completed(parsing):
+            class_name, url, entry = parsing[future]
+            try:
+                assignments = [Assignment(class_name, title, due, html=html)
+                    for (title, due, html) in future.result()]
+                assignments = [a for a in assignments
+                    if not (skip and worker_skip is None and skip(a))]
+                cache_first(class_name, url, entry, assignments)
+            except Exception as e:
+                print(f'Error parsing {class_name}')
+                continue
+            yield (class_name, url, assignments)
+
+    # also runs if the caller stops early
+    finally:
+        if workers:
+            workers.shutdown(cancel_futures=True)
+        if cache:
+            cache.save()
+
+
+def get_sites_assignments(sites, max_workers=MAX_WORKERS, timeout=TIMEOUT,
+    use_cache=None, parser=None, skip=None, processes=None):
+    '''
+    Gets the assignments of a list of course sites
+    (see iter_sites_assignments).
+
+    params:
+    - sites, max_workers, timeout, use_cache, parser, skip, processes:
+      see iter_sites_assignments
+
+    returns:
+    - a list with a list of Assignments for each site, in the same order
+    '''
+
+    parsed = {(class_name, url): assignments
+        for (class_name, url, assignments) in iter_sites_assignments(sites,
+            max_workers, timeout, use_cache, parser, skip, processes)}
+
+    return [parsed.get((class_name, site_info['url']), [])
+        for (class_name, site_info) in sites]
+
+
+def get_assignments(max_workers=MAX_WORKERS, timeout=TIMEOUT, use_cache=None,
+    parser=None, skip=None, sites_info=None, processes=None):
+    '''
+    Gets all assignments from all sites in site_info
+    (see get_sites_assignments).
+
+    params:
+    - max_workers, timeout, use_cache, parser, skip, processes:
+      see get_sites_assignments
+    - sites_info: a dictionary of class name to site info;
+      if None, it is loaded from site-info.json
+
+    returns:
+    - a list of Assignments, in the order the sites are listed in site_info
     '''
 
     assignments = None
 
     # abort operation if no assignment pages found
-    sites_info = _load_sites_info()
+    if sites_info is None:
+        sites_info = load_sites_info()
     if len(sites_info.items()) == 0:
         print('No assignment pages found')
 
-    # get assignments from every page
+    # get assignments from every page, in a deterministic order
     else:
         assignments = []
-        for (class_name, site_info) in sites_info.items():
-            try:
-                assignments.extend(_get_site_assignments(class_name, site_info))
-            except Exception as e:
-                print(f'Error parsing {class_name}')
+        for site_assignments in get_sites_assignments(list(sites_info.items()),
+            max_workers, timeout, use_cache, parser, skip, processes):
+            assignments.extend(site_assignments)
 
     return assignments
 
 
+def iter_assignments(max_workers=MAX_WORKERS, timeout=TIMEOUT, use_cache=None,
+    parser=None, skip=None, sites_info=None, processes=None):
+    '''
+    Yields the assignments from all sites in site_info one at a time,
+    a page at a time as soon as each page is parsed (see
+    iter_sites_assignments), so only the pages being worked on are held.
+
+    params:
+    - max_workers, timeout, use_cache, parser, skip, processes:
+      see iter_sites_assignments
+    - sites_info: a dictionary of class name to site info;
+      if None, it is loaded from site-info.json
+
+    returns:
+    - a generator of Assignments, in the order the pages finish
+    '''
+
+    if sites_info is None:
+        sites_info = load_sites_info()
+    if len(sites_info.items()) == 0:
+        print('No assignment pages found')
+        return
+
+    for (_, _, assignments) in iter_sites_assignments(list(sites_info.items()),
+        max_workers, timeout, use_cache, parser, skip, processes):
+        yield from assignments
+
+
 if __name__ == '__main__':
     data = get_assignments()
     if data:
+        data = [a.to_dict(render=True) for a in data]
         print(f'Data scraped from GFU pages:\n{json.dumps(data, indent=2)}')
     else:
         print('No data found ¯\_(ツ)_/¯')
\ No newline at end of file
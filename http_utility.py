@@ -0,0 +1,333 @@
+'''
+Shared HTTP client used by the GFU, Canvas, and Trello utilities.
+
+All requests go through one requests.Session so connections are kept alive
+and pooled per host, with default timeouts and retry/backoff for failed
+idempotent requests, and optional per-host rate limits shared by every
+thread. The client also counts connection reuse and records a
+latency histogram for every host.
+'''
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics_utility, requests, time
+
+
+# hosts with an open connection pool (GFU sites, Canvas, Trello, ...)
+POOL_CONNECTIONS = 16
+
+# connections kept open per host
+POOL_MAXSIZE = 8
+
+# default seconds to wait for a server
+TIMEOUT = 30
+
+# retries for failed idempotent requests, with exponential backoff
+RETRIES = 3
+BACKOFF = 0.5
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+def retry_delay(response, attempt):
+    '''
+    Returns how many seconds to wait before retrying a rate limited
+    request: as long as the response's Retry-After header asks (either
+    seconds or an HTTP date), or exponential backoff without one.
+
+    params:
+    - response: the rate limited response
+    - attempt: the number of the attempt that failed, from 0
+    '''
+
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return 2 ** attempt
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return 2 ** attempt
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket; each request takes one token and tokens
+    refill at a fixed rate up to the bucket's capacity.
+    '''
+
+    def __init__(self, rate, capacity):
+        '''
+        params:
+        - rate: tokens added per second
+        - capacity: the most tokens the bucket holds (largest burst)
+        '''
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def _try_take(self):
+        '''
+        Takes a token if one is available.
+
+        returns:
+        - None if a token was taken, otherwise the seconds until one is
+        '''
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return None
+            return (1 - self._tokens) / self.rate
+
+    def take(self):
+        '''
+        Blocks until a token is available, then takes it.
+        '''
+
+        while True:
+            wait = self._try_take()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    async def take_async(self):
+        '''
+        Waits until a token is available without blocking the event loop,
+        then takes it. Shares its tokens with take.
+        '''
+
+        # only the async engine needs asyncio, which is slow to import
+        import asyncio
+
+        while True:
+            wait = self._try_take()
+            if wait is None:
+                return
+            await asyncio.sleep(wait)
+
+
+class HttpClient:
+    '''
+    Pooled, retrying HTTP client with per-host instrumentation
+    and optional per-host rate limits.
+    '''
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE, timeout=TIMEOUT,
+        retries=RETRIES, backoff=BACKOFF):
+        '''
+        params:
+        - pool_connections: the number of hosts to keep connection pools for
+        - pool_maxsize: the most connections kept open to a single host
+        - timeout: default seconds to wait for a server
+        - retries: times a failed GET/HEAD/PUT/DELETE is retried
+        - backoff: backoff factor between retries, in seconds
+        '''
+
+        self.timeout = timeout
+        self._lock = Lock()
+        self._hosts = {}
+        self._limits = {}
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False)
+        self._adapter = HTTPAdapter(pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = self._session(self._adapter)
+
+        # for requests whose timeout has to cap how long they take
+        self._single_adapter = HTTPAdapter(pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize, max_retries=0)
+        self._single_session = self._session(self._single_adapter)
+
+    @staticmethod
+    def _session(adapter):
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def limit(self, host, rate, capacity=None):
+        '''
+        Rate limits every request to a host, across all threads.
+
+        params:
+        - host: the host name, e.g. api.trello.com
+        - rate: requests per second
+        - capacity: the largest burst; defaults to one second's worth
+        '''
+
+        self._limits[host] = TokenBucket(rate, capacity or rate)
+
+    def request(self, method, url, retry=True, **kwargs):
+        '''
+        Sends a request through the pooled session; takes the same
+        arguments as requests.request.
+
+        params:
+        - retry: if False, a failed request isn't retried, so its timeout
+          caps how long it takes
+
+        returns:
+        - a requests.Response
+        '''
+
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session if retry else self._single_session
+
+        limiter = self._limits.get(urlsplit(url).hostname)
+        if limiter:
+            limiter.take()
+
+        with metrics_utility.span('http ' + urlsplit(url).hostname, 'http'):
+            start = time.perf_counter()
+            response = session.request(method, url, **kwargs)
+            self._record(url, time.perf_counter() - start)
+            metrics_utility.add(bytes=len(response.content), requests=1)
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _record(self, url, elapsed):
+        '''
+        Adds a request to the host's latency histogram and takes a snapshot
+        of the host's connection pool counters.
+        '''
+
+        parts = urlsplit(url)
+        host = parts.netloc
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+
+        # a host can have several pools (e.g. with different TLS settings)
+        connections = 0
+        pool_requests = 0
+        for adapter in (self._adapter, self._single_adapter):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None and (pool.host, pool.port) == (parts.hostname, port):
+                    connections += pool.num_connections
+                    pool_requests += pool.num_requests
+
+        with self._lock:
+            stats = self._hosts.setdefault(host, {
+                'requests': 0,
+                'total_time': 0.0,
+                'histogram': [0] * len(LATENCY_BUCKETS),
+                'connections': 0,
+                'pool_requests': 0})
+            stats['requests'] += 1
+            stats['total_time'] += elapsed
+            for (i, bound) in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    stats['histogram'][i] += 1
+                    break
+            stats['connections'] = connections
+            stats['pool_requests'] = pool_requests
+
+    def stats(self):
+        '''
+        Returns the instrumentation collected so far.
+
+        returns:
+        - a dictionary of host to a dictionary with the keys requests,
+          total_time, histogram (counts per LATENCY_BUCKETS bucket),
+          connections (new connections opened), and reused
+          (requests sent over an already open connection)
+        '''
+
+        with self._lock:
+            result = {}
+            for (host, s) in self._hosts.items():
+                result[host] = {
+                    'requests': s['requests'],
+                    'total_time': s['total_time'],
+                    'histogram': list(s['histogram']),
+                    'connections': s['connections'],
+                    'reused': max(0, s['pool_requests'] - s['connections'])}
+            return result
+
+    def print_stats(self):
+        '''
+        Prints connection reuse and the latency histogram for every host.
+        '''
+
+        labels = ['<={}s'.format(b) if b != float('inf') else '>{}s'.format(
+            LATENCY_BUCKETS[-2]) for b in LATENCY_BUCKETS]
+
+        print('HTTP stats:')
+        for (host, s) in sorted(self.stats().items()):
+            print('{}: {} requests, {} connections opened, {} reused, {:.2f}s avg'
+                .format(host, s['requests'], s['connections'], s['reused'],
+                s['total_time'] / s['requests']))
+            print('  ' + '  '.join('{} {}'.format(label, count)
+                for (label, count) in zip(labels, s['histogram']) if count))
+        print()
+
+
+_client = None
+_client_lock = Lock()
+
+
+def configure(**kwargs):
+    '''
+    Replaces the shared client with one built from the given HttpClient
+    arguments (pool sizes, timeout, retries, backoff).
+    '''
+
+    global _client
+    with _client_lock:
+        _client = HttpClient(**kwargs)
+    return _client
+
+
+def get_client():
+    '''
+    Returns the shared client, creating it with the defaults if needed.
+    '''
+
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+
+def request(method, url, **kwargs):
+    return get_client().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return get_client().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_client().post(url, **kwargs)
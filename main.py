@@ -3,21 +3,28 @@ Main driver that pulls info from Trello, GFU CSIS Course Sites, and Canvas
 and determines which ones are "new" (have not been added to Trello) and
 uploads those.
 
-After parsing, each assignment will be a Python dictionary with these keys:
-{
-  'class'
-  'due'
-  'title'
-  'description'
-}
+After parsing, each assignment is an assignment_utility.Assignment.
 '''
 
-from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
+from dedup_utility import AssignmentIndex
+from state_utility import AssignmentStore
+from threading import Thread
+import contextlib, json, queue, sys, time
+import config_utility, daemon_utility, http_utility, markdown_utility, metrics_utility
 import gfu_utility as cs_scraper
 import trello_utility as trello
 import canvas_utility as canvas
 
 
+# the most assignments waiting between the sources and the dedup step
+# when streaming; a full queue pauses the sources
+STREAM_QUEUE_SIZE = 100
+
+# put on the stream queue by a source when it has no more assignments
+_DONE = object()
+
+
 def print_assignments(assignments):
     '''
     Prints each assignment's class title, assignment title, and due date.
@@ -31,46 +38,235 @@ def print_assignments(assignments):
 
     print()
     for a in assignments:
-        due = datetime.fromisoformat(a['due'])
-        print('Class:\t\t{}'.format(a['class']))
-        print('Title:\t\t{}'.format(a['title']))
-        print('Due date:\t{}/{}'.format(due.month, due.day))
+        print('Class:\t\t{}'.format(a.class_name))
+        print('Title:\t\t{}'.format(a.title))
+        print('Due date:\t{}/{}'.format(a.due_at.month, a.due_at.day))
         print()
 
 
+@metrics_utility.measured('stage.dedup')
 def filter_new_assignments(old_assignments, new_assignments):
     '''
-    Compare assignments by title and date and return the new ones.
+    Compare assignments by title and class and return the new ones.
 
     params:
-    - old_assignments: a dict of assignments
-    - new_assignments: a dict of assignments
+    - old_assignments: a list of assignments or an AssignmentIndex
+      built from them
+    - new_assignments: a list of assignments
 
     returns:
-    - a dict of new assignments (new assignment name not in old assignments
+    - a list of new assignments (new assignment name not in old assignments
       and due date is in the future)
     '''
 
-    result = []
-    for a_new in new_assignments:
+    if not isinstance(old_assignments, AssignmentIndex):
+        old_assignments = AssignmentIndex(old_assignments)
+
+    return old_assignments.filter_new(new_assignments)
+
+
+def diff_new_assignments(known_assignments, sources):
+    '''
+    Merges the new assignments of every source into a single diff against
+    Trello. Assignments found by an earlier source (or twice by the same
+    one) are only listed once.
+
+    params:
+    - known_assignments: an AssignmentIndex of the assignments on Trello;
+      the new assignments are added to it
+    - sources: a dictionary of source name to the source's assignments,
+      in the order the sources should be checked
+
+    returns:
+    - a list of (source name, assignment) tuples
+    '''
+
+    return list(iter_new_assignments(known_assignments,
+        ((source, a) for (source, assignments) in sources.items()
+        for a in assignments or [])))
+
+
+def iter_new_assignments(known_assignments, records):
+    '''
+    Dedups assignments against Trello as they arrive (see
+    diff_new_assignments); an assignment found twice is only yielded
+    the first time.
+
+    params:
+    - known_assignments: an AssignmentIndex of the assignments on Trello;
+      the new assignments are added to it
+    - records: an iterable of (source name, assignment) tuples,
+      e.g. from stream_sources
+
+    returns:
+    - a generator of the new (source name, assignment) tuples
+    '''
+
+    for (source, a) in records:
+        if known_assignments.is_new(a):
+            known_assignments.add(a)
+            yield (source, a)
+
+
+def stream_sources(sources, maxsize=STREAM_QUEUE_SIZE):
+    '''
+    Starts reading every source in its own thread right away and merges
+    their assignments in the order they arrive. At most maxsize
+    assignments wait to be read; sources are paused until there is room.
+    A source that fails is reported and ends early, keeping the
+    assignments it already found; the other sources carry on.
+
+    params:
+    - sources: a dictionary of source name to an iterable of the
+      source's assignments (e.g. a generator from the source's module)
+    - maxsize: the most assignments waiting to be read
+
+    returns:
+    - a generator of (source name, assignment) tuples
+    '''
+
+    records = queue.Queue(maxsize)
+
+    def produce(name, assignments):
+        try:
+            with metrics_utility.span('stage.' + name) as span:
+                for a in assignments or []:
+                    records.put((name, a))
+                    span.rows += 1
+        except Exception as e:
+            print('Error fetching {}: {}'.format(name, e))
+        finally:
+            records.put((name, _DONE))
+
+    for (name, assignments) in sources.items():
+        Thread(target=metrics_utility.bind(produce), args=(name, assignments),
+            daemon=True).start()
+
+    def receive(running):
+        while running:
+            (name, item) = records.get()
+            if item is _DONE:
+                running -= 1
+            else:
+                yield (name, item)
+
+    return receive(len(sources))
+
+
+def stream_new_assignments(query, trello_board_id, trello_lists, store=None):
+    '''
+    Finds new assignments as a stream: the CS sites and Canvas are read
+    while the Trello cards are indexed, and every assignment is deduped
+    as soon as it arrives, so only the index and the assignments waiting
+    in between are held.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - trello_board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - store: an AssignmentStore to sync Trello cards into, or None
+
+    returns:
+    - a generator of the new (source name, assignment) tuples,
+      in the order they were found
+    '''
+
+    stages = _source_stages(query, trello_board_id, trello_lists, store,
+        stream=True)
+    records = stream_sources({name: func(*args, **kwargs)
+        for (name, (func, args, kwargs)) in stages.items() if name != 'Trello'})
+
+    # nothing is new until every Trello card has been seen
+    func, args, kwargs = stages['Trello']
+    with metrics_utility.span('stage.Trello') as span:
+        known_assignments = AssignmentIndex(func(*args, **kwargs))
+        span.rows = len(known_assignments)
 
-        # only add upcoming assignments
-        upcoming = a_new['due'] > date.today().isoformat()
-        if upcoming:
+    return iter_new_assignments(known_assignments, records)
 
-            # only add assignments that aren't in old_assignments
-            exclusive = True
-            for a_old in old_assignments:
-                if a_new['title'] == a_old['title'] \
-                and a_new['class'] == a_old['class']:
-                    exclusive = False
-                    break
-            if exclusive:
-                result.append(a_new)
 
+def apply_new_assignments(query, board_id, list_id, diff):
+    '''
+    Adds every assignment of a diff to Trello without asking, starting
+    each card as soon as its assignment arrives (see
+    trello_utility.upload_stream).
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - board_id: the ID of board where new assignments will be added
+    - list_id: the ID of the list to add new assignments to
+    - diff: an iterable of (source name, assignment) tuples
+      (see diff_new_assignments and stream_new_assignments)
+
+    returns:
+    - a report dictionary with the number of cards created, skipped
+      (no Trello label for the class), and failed, plus the report
+      of each card in the order they were done
+      (see trello_utility.upload_assignments)
+    '''
+
+    sources = {}
+    def assignments():
+        for (source, a) in diff:
+            sources[a] = source
+            yield a
+
+    reports = []
+    with metrics_utility.span('stage.upload') as span:
+        for (a, report) in trello.upload_stream(query, assignments(),
+            board_id, list_id):
+            report['source'] = sources.pop(a)
+            report['due'] = a.due
+            reports.append(report)
+        span.rows = len(reports)
+
+    return summarize(reports)
+
+
+def summarize(reports):
+    '''
+    Counts the cards created, skipped, and failed in the reports of an
+    upload (see apply_new_assignments).
+    '''
+
+    result = {status: sum(1 for r in reports if r['status'] == status)
+        for status in ('created', 'skipped', 'failed')}
+    result['cards'] = reports
     return result
 
 
+def json_to_stdout(report=True):
+    '''
+    Returns whether --dry-run, or else --report, prints its JSON to stdout.
+
+    params:
+    - report: whether --report is used by this run
+    '''
+
+    dry_run = config_utility.option('--dry-run', '-')
+    if dry_run:
+        return dry_run == '-'
+    return report and config_utility.option('--report', '-') == '-'
+
+
+def write_json(path, data, stdout=None):
+    '''
+    Writes data as JSON to a file, or prints it if the path is "-".
+
+    params:
+    - path: the file to write, or "-"
+    - data: the data to write
+    - stdout: the stream to print to, if not sys.stdout
+    '''
+
+    if path == '-':
+        print(json.dumps(data, indent=2), file=stdout or sys.stdout)
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+        print('Written to {}'.format(path))
+
+
 def handle_new_assignments(query, board_id, list_id, new_assignments, ask_to_add=False):
     '''
     Prints out new assignments and (optionally) asks user if they should be
@@ -104,9 +300,12 @@ def handle_new_assignments(query, board_id, list_id, new_assignments, ask_to_add
 
             # add new assignments iff user entered y or yes
             if choice == 'y' or choice == 'yes':
-                trello.upload_assignments( \
-                    query, new_assignments, board_id, list_id)
-                assignments_added = True
+                with metrics_utility.span('stage.upload') as span:
+                    reports = trello.upload_assignments( \
+                        query, new_assignments, board_id, list_id)
+                    span.rows = len(reports)
+                assignments_added = any( \
+                    r['status'] == 'created' for r in reports)
                 ask_to_add = False
 
             # if choice not valid, say so!
@@ -122,6 +321,161 @@ def handle_new_assignments(query, board_id, list_id, new_assignments, ask_to_add
     return assignments_added
 
 
+def _timed(name, func, *args, **kwargs):
+    '''
+    Calls a function and measures how long it took,
+    recording it as the stage's span (see metrics_utility).
+
+    params:
+    - name: the name of the stage
+    - func: the function to call
+    - args, kwargs: arguments passed to func
+
+    returns:
+    - a tuple of the function's return value and elapsed seconds
+    '''
+
+    with metrics_utility.span('stage.' + name) as span:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        span.rows = len(result or [])
+        return (result, time.perf_counter() - start)
+
+
+def _source_stages(query, trello_board_id, trello_lists, store=None,
+    stream=False):
+    '''
+    Describes how to fetch assignments from each source.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - trello_board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - store: an AssignmentStore to sync Trello cards into, or None
+    - stream: if True, the functions return generators that yield
+      assignments as they are found instead of lists
+
+    returns:
+    - a dictionary of source name to (function, args, kwargs)
+    '''
+
+    # past-due assignments are always thrown away by the dedup step,
+    # so the sources can leave them out
+    skip = AssignmentIndex().is_past
+
+    # Trello cards are only used to find new assignments, so their
+    # descriptions aren't downloaded
+    return {
+        'Trello': (trello.iter_assignments if stream else trello.get_assignments,
+            (query, trello_lists),
+            {'board_id': trello_board_id, 'store': store, 'include_desc': False}),
+        'CS sites': (cs_scraper.iter_assignments if stream
+            else cs_scraper.get_assignments, (), {'skip': skip}),
+        'Canvas': (canvas.stream_assignments if stream else canvas.get_assignments, (),
+            {'included_accounts': ['Undergrad Programs'],
+            'paginate': '--paginate' in sys.argv[1:], 'skip': skip,
+            'incremental': '--incremental' in sys.argv[1:]}),
+    }
+
+
+def collect_assignments(query, trello_board_id, trello_lists, store=None):
+    '''
+    Runs the Trello, CS site, and Canvas collection stages at the same time
+    and waits for all of them to finish. Prints how long each stage took.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - trello_board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - store: an AssignmentStore to sync Trello cards into, or None
+
+    returns:
+    - a tuple of Trello, CS site, and Canvas assignments
+    '''
+
+    stages = _source_stages(query, trello_board_id, trello_lists, store)
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        futures = {
+            name: pool.submit(_timed, name, func, *args, **kwargs)
+            for (name, (func, args, kwargs)) in stages.items()}
+        results = {name: future.result() for (name, future) in futures.items()}
+
+    print('\nStage timings:')
+    for (name, (_, elapsed)) in results.items():
+        print('{:<12}{:.2f}s'.format(name, elapsed))
+    print()
+
+    return tuple(result for (result, _) in results.values())
+
+
+def run_daemon(query, trello_board_id, trello_lists, store):
+    '''
+    Polls every source forever on its own schedule (see daemon_utility)
+    and adds new assignments to Trello without asking.
+    Connections, config files, and the dedup index stay loaded between polls.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - trello_board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - store: the AssignmentStore Trello cards are synced into
+
+    returns:
+    - none
+    '''
+
+    stages = _source_stages(query, trello_board_id, trello_lists, store)
+    state = {'known': AssignmentIndex()}
+
+    def poll_trello():
+        func, args, kwargs = stages['Trello']
+        known = AssignmentIndex(func(*args, **kwargs))
+        changed = len(known) != len(state['known'])
+        state['known'] = known
+        return changed
+
+    def poll_source(name):
+        def poll():
+            func, args, kwargs = stages[name]
+            new_assignments = state['known'].filter_new(func(*args, **kwargs) or [])
+            if not new_assignments:
+                return False
+
+            print('{} new assignments found on {}:'.format(len(new_assignments), name))
+            print_assignments(new_assignments)
+            trello.upload_assignments(query, new_assignments,
+                trello_board_id, trello_lists["To-Do"])
+            state['known'].extend(new_assignments)
+            return True
+        return poll
+
+    # every poll is a stage; the Prometheus textfile is kept up to date
+    prometheus = config_utility.option('--prometheus', metrics_utility.PROMETHEUS_PATH)
+    def measured(name, poll):
+        def job():
+            with metrics_utility.span('poll.' + name):
+                changed = poll()
+            if prometheus:
+                metrics_utility.get_metrics().write_prometheus(prometheus)
+            return changed
+        return job
+
+    # the dedup index has to exist before any other source is checked
+    poll_trello()
+
+    jobs = []
+    for (name, (interval, max_interval)) in daemon_utility.INTERVALS.items():
+        schedule = daemon_utility.SourceSchedule(name, interval, max_interval)
+        if name == 'Trello':
+            schedule.done(True, time.time())
+            jobs.append((schedule, measured(name, poll_trello)))
+        else:
+            jobs.append((schedule, measured(name, poll_source(name))))
+
+    daemon_utility.run(jobs)
+
+
 def main():
     '''
     Loads program data from files,
@@ -135,32 +489,144 @@ def main():
     - none
     '''
 
+    # while --dry-run or --report prints JSON, everything else is printed
+    # to stderr so that the JSON can be piped
+    stdout = sys.stdout
+    if '--check' not in sys.argv[1:] and json_to_stdout('--yes' in sys.argv[1:]):
+        with contextlib.redirect_stdout(sys.stderr):
+            _main(stdout)
+    else:
+        _main(stdout)
+
+
+def _main(stdout):
+    '''
+    Runs the program (see main), printing any JSON to stdout.
+    '''
+
+    # instrumentation is only recorded when it is going to be reported
+    if any(arg.split('=')[0] in ('--metrics', '--trace', '--prometheus', '--profile')
+        for arg in sys.argv[1:]):
+        metrics_utility.configure(enabled=True)
+
     # load program data from files
     query = trello.load_credentials()
     trello_board_id, trello_lists = trello.load_board_info()
 
-    # get assignments
-    trello_assignments = trello.get_assignments(query, trello_lists)
-    cs_assignments = cs_scraper.get_assignments()
-    canvas_assignments = canvas.get_assignments( \
-        included_accounts=['Undergrad Programs'])
+    # converted descriptions are kept between runs unless --no-cache;
+    # --check never converts any
+    check = '--check' in sys.argv[1:]
+    if '--no-cache' not in sys.argv[1:] and not check:
+        markdown_utility.configure(path=markdown_utility.CACHE_PATH)
+
+    # local copy of the Trello cards, synced incrementally;
+    # --full-sync re-downloads the whole board
+    store = AssignmentStore()
+    if '--full-sync' in sys.argv[1:]:
+        store.clear()
+
+    # keep polling instead of running once
+    if '--daemon' in sys.argv[1:]:
+        run_daemon(query, trello_board_id, trello_lists, store)
+        store.close()
+        markdown_utility.get_cache().save()
+        _report_metrics()
+        return
+
+    # only count the new assignments, without rendering or adding any;
+    # assignments are streamed from the sources and never all held
+    dry_run = config_utility.option('--dry-run', '-')
+    if check:
+        counts = {'CS sites': 0, 'Canvas': 0}
+        for (source, _) in stream_new_assignments(
+            query, trello_board_id, trello_lists, store):
+            counts[source] += 1
+        store.close()
+        print('{} new assignments ({} from CS sites, {} from Canvas)'.format(
+            sum(counts.values()), counts['CS sites'], counts['Canvas']))
+
+    # add every new assignment without asking, as soon as it is found
+    elif '--yes' in sys.argv[1:] and not dry_run:
+        report = apply_new_assignments(query, trello_board_id,
+            trello_lists["To-Do"], stream_new_assignments(
+            query, trello_board_id, trello_lists, store))
+        store.close()
+        print('{} created, {} skipped (no Trello label), {} failed'.format(
+            report['created'], report['skipped'], report['failed']))
+        report_path = config_utility.option('--report', '-')
+        if report_path:
+            write_json(report_path, report, stdout)
+
+    # list every new assignment without asking
+    elif dry_run:
+        trello_assignments, cs_assignments, canvas_assignments = \
+            collect_assignments(query, trello_board_id, trello_lists, store)
+        store.close()
+        diff = diff_new_assignments(AssignmentIndex(trello_assignments),
+            {'CS sites': cs_assignments, 'Canvas': canvas_assignments})
+        write_json(dry_run, {'new': [
+            dict(a.to_dict(render=True), source=source)
+            for (source, a) in diff]}, stdout)
+
+    else:
+        # get assignments from every source at once
+        trello_assignments, cs_assignments, canvas_assignments = \
+            collect_assignments(query, trello_board_id, trello_lists, store)
+        store.close()
+        known_assignments = AssignmentIndex(trello_assignments)
 
-    # handle new Trello assignments (if any)
-    if cs_assignments:
-        added = handle_new_assignments(query, trello_board_id, trello_lists["To-Do"],
-            filter_new_assignments(trello_assignments, cs_assignments),
-            ask_to_add=True)
+        # handle new Trello assignments (if any)
+        if cs_assignments:
+            added = handle_new_assignments(query, trello_board_id, trello_lists["To-Do"],
+                filter_new_assignments(known_assignments, cs_assignments),
+                ask_to_add=True)
 
-        # account for assignments that appear on CS sites *and* Canvas
-        if added:
-            trello_assignments.extend(cs_assignments)
+            # account for assignments that appear on CS sites *and* Canvas
+            if added:
+                known_assignments.extend(cs_assignments)
 
-    # handle new Canvas assignments
-    if canvas_assignments:
-        handle_new_assignments(query, trello_board_id, trello_lists["To-Do"],
-            filter_new_assignments(trello_assignments, canvas_assignments),
-            ask_to_add=True)
+        # handle new Canvas assignments
+        if canvas_assignments:
+            handle_new_assignments(query, trello_board_id, trello_lists["To-Do"],
+                filter_new_assignments(known_assignments, canvas_assignments),
+                ask_to_add=True)
+
+    # descriptions are only converted for uploaded assignments
+    markdown_utility.get_cache().print_stats()
+    markdown_utility.get_cache().save()
+
+    # connection reuse and latency per host
+    if '--stats' in sys.argv[1:]:
+        http_utility.get_client().print_stats()
+
+    _report_metrics()
+
+
+def _report_metrics():
+    '''
+    Prints and writes the instrumentation of the run,
+    as requested by --metrics, --trace, and --prometheus.
+    '''
+
+    metrics = metrics_utility.get_metrics()
+
+    if '--metrics' in sys.argv[1:]:
+        metrics.print_summary()
+
+    trace = config_utility.option('--trace', metrics_utility.TRACE_PATH)
+    if trace:
+        metrics.write_trace(trace)
+
+    prometheus = config_utility.option('--prometheus', metrics_utility.PROMETHEUS_PATH)
+    if prometheus:
+        metrics.write_prometheus(prometheus)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # profile a single run with --profile
+    profile = config_utility.option('--profile', metrics_utility.PROFILE_PATH)
+    if profile:
+        with metrics_utility.profile(profile):
+            main()
+    else:
+        main()
\ No newline at end of file
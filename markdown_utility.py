@@ -0,0 +1,130 @@
+'''
+Memoized HTML to Markdown conversion for assignment descriptions.
+
+Nearly every description is the same from one run to the next, so
+conversions are cached by a hash of the HTML: in memory with LRU eviction,
+and optionally in a file so the cache survives between runs.
+'''
+
+from collections import OrderedDict
+from threading import Lock
+import config_utility, hashlib, os, time, metrics_utility
+
+
+CACHE_PATH = os.path.join('.cache', 'markdown.json')
+
+# most conversions kept, least recently used are evicted first
+MAX_ENTRIES = 5000
+
+
+class MarkdownCache:
+    '''
+    LRU cache of HTML to Markdown conversions keyed by content hash,
+    which also keeps track of its hit rate and the time it saved.
+    '''
+
+    def __init__(self, max_entries=MAX_ENTRIES, path=None):
+        '''
+        params:
+        - max_entries: the most conversions kept
+        - path: a JSON file to load the cache from and save() it to,
+          or None to keep it in memory only
+        '''
+
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        if path:
+            for (key, entry) in config_utility.load_json_file(path).items():
+                self._entries[key] = tuple(entry)
+
+    def convert(self, html):
+        '''
+        Converts HTML to Markdown, reusing an earlier conversion of the
+        same HTML if there is one.
+
+        params:
+        - html: the HTML to convert
+
+        returns:
+        - the Markdown
+        '''
+
+        key = hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved += entry[1]
+                return entry[0]
+
+        # markdownify (and bs4 under it) is only imported once something
+        # actually needs converting
+        import markdownify
+
+        with metrics_utility.span('markdown.convert', 'parse'):
+            start = time.perf_counter()
+            markdown = markdownify.markdownify(html)
+            cost = time.perf_counter() - start
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (markdown, cost)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return markdown
+
+    def save(self):
+        '''
+        Writes the cache to its file, if it has one.
+        '''
+
+        if not self.path:
+            return
+
+        with self._lock:
+            config_utility.save_json_file(self.path, self._entries)
+
+    def print_stats(self):
+        '''
+        Prints the hit rate and the conversion time saved.
+        '''
+
+        total = self.hits + self.misses
+        if total:
+            print('Markdown cache: {} of {} descriptions cached ({:.0%}), {:.2f}s saved'
+                .format(self.hits, total, self.hits / total, self.saved))
+
+
+_cache = MarkdownCache()
+
+
+def configure(**kwargs):
+    '''
+    Replaces the shared cache with one built from the given MarkdownCache
+    arguments (max_entries, path).
+    '''
+
+    global _cache
+    _cache = MarkdownCache(**kwargs)
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def to_markdown(html):
+    '''
+    Converts HTML to Markdown through the shared cache.
+    '''
+
+    return _cache.convert(html)
+
@@ -0,0 +1,317 @@
+'''
+Instrumentation of a run: wall time, bytes downloaded, request count, and
+rows produced for every stage and every per-site/per-request call.
+
+Code to be measured is wrapped in span(name) or decorated with
+measured(name). HTTP requests made inside a span (see http_utility) add
+their bytes to it and every span around it, so the numbers of a span
+include everything it called, including on pool threads started through
+bind(func). Recording is off until configure(enabled=True), and spans
+then cost a few microseconds.
+
+The results can be printed as a summary table, written as a Chrome trace
+(open in chrome://tracing or https://ui.perfetto.dev), or written as a
+Prometheus textfile (for the node_exporter textfile collector).
+'''
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local, get_ident
+import config_utility, os, time
+
+
+# most spans kept for the trace; totals keep counting after that
+MAX_SPANS = 100000
+
+# default files for --trace, --prometheus, and --profile
+TRACE_PATH = os.path.join('.cache', 'trace.json')
+PROMETHEUS_PATH = os.path.join('.cache', 'assignment_scraper.prom')
+PROFILE_PATH = os.path.join('.cache', 'profile.out')
+
+# prefix of every Prometheus metric name
+PROMETHEUS_PREFIX = 'assignment_scraper'
+
+
+class Span:
+    '''
+    A single timed call and what it did.
+    '''
+
+    __slots__ = ('name', 'category', 'start', 'duration', 'thread',
+        'bytes', 'requests', 'rows')
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.thread = get_ident()
+        self.bytes = 0
+        self.requests = 0
+        self.rows = 0
+
+
+class Metrics:
+    '''
+    Spans recorded during a run plus running totals for each span name.
+    '''
+
+    def __init__(self, enabled=False, max_spans=MAX_SPANS):
+        '''
+        params:
+        - enabled: whether spans are recorded at all
+        - max_spans: the most spans kept for write_trace
+        '''
+
+        self.enabled = enabled
+        self.max_spans = max_spans
+        self._origin = time.perf_counter()
+        self._lock = Lock()
+        self._local = local()
+        self._spans = []
+        self._totals = {}
+
+    @contextmanager
+    def span(self, name, category='stage'):
+        '''
+        Times the code in a with block. Set .rows on the span it yields to
+        record how many rows (assignments, cards, ...) the code produced.
+
+        params:
+        - name: what is being timed, e.g. "gfu.parse"
+        - category: a group for the trace, e.g. "stage", "http", "parse"
+        '''
+
+        span = Span(name, category)
+        if not self.enabled:
+            yield span
+            return
+
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.start
+            stack.pop()
+            self._finish(span)
+
+    def add(self, bytes=0, requests=0):
+        '''
+        Adds downloaded bytes and requests to every open span of the
+        calling thread.
+        '''
+
+        if self.enabled:
+            with self._lock:
+                for span in getattr(self._local, 'stack', ()):
+                    span.bytes += bytes
+                    span.requests += requests
+
+    def bind(self, func):
+        '''
+        Wraps a function that will run on another thread (e.g. in a thread
+        pool) so whatever it does is also added to the spans that are open
+        on the calling thread now.
+        '''
+
+        if not self.enabled:
+            return func
+
+        parents = list(getattr(self._local, 'stack', ()))
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            saved = getattr(self._local, 'stack', None)
+            self._local.stack = list(parents)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = saved
+        return wrapper
+
+    def _finish(self, span):
+        with self._lock:
+            if len(self._spans) < self.max_spans:
+                self._spans.append(span)
+            total = self._totals.setdefault(span.name, [0, 0.0, 0, 0, 0])
+            total[0] += 1
+            total[1] += span.duration
+            total[2] += span.bytes
+            total[3] += span.requests
+            total[4] += span.rows
+
+    def totals(self):
+        '''
+        Returns a dictionary of span name to a dictionary with the keys
+        calls, seconds, bytes, requests, and rows, summed over every call.
+        '''
+
+        with self._lock:
+            return {name: dict(zip(
+                ('calls', 'seconds', 'bytes', 'requests', 'rows'), total))
+                for (name, total) in self._totals.items()}
+
+    def print_summary(self):
+        '''
+        Prints a table of the totals, slowest first. Times of nested spans
+        are included in the spans around them.
+        '''
+
+        totals = sorted(self.totals().items(), key=lambda t: -t[1]['seconds'])
+        if not totals:
+            return
+
+        print('{:<26}{:>8}{:>11}{:>11}{:>10}{:>8}'.format(
+            'Span', 'calls', 'wall (s)', 'requests', 'KB', 'rows'))
+        for (name, t) in totals:
+            print('{:<26}{:>8}{:>11.3f}{:>11}{:>10.1f}{:>8}'.format(
+                name, t['calls'], t['seconds'], t['requests'],
+                t['bytes'] / 1e3, t['rows']))
+        print()
+
+    def write_trace(self, path):
+        '''
+        Writes the recorded spans as a Chrome trace (JSON trace event format).
+        '''
+
+        with self._lock:
+            spans = list(self._spans)
+
+        events = [{
+            'name': s.name,
+            'cat': s.category,
+            'ph': 'X',
+            'ts': (s.start - self._origin) * 1e6,
+            'dur': s.duration * 1e6,
+            'pid': os.getpid(),
+            'tid': s.thread,
+            'args': {'bytes': s.bytes, 'requests': s.requests, 'rows': s.rows},
+        } for s in spans]
+
+        config_utility.save_json_file(path,
+            {'traceEvents': events, 'displayTimeUnit': 'ms'})
+        print('Trace written to {}'.format(path))
+
+    def write_prometheus(self, path):
+        '''
+        Writes the totals in the Prometheus text format. The file is
+        replaced atomically so a collector never reads half of it.
+        '''
+
+        metrics = [
+            ('calls', 'calls_total', 'Number of calls'),
+            ('seconds', 'seconds_total', 'Wall time spent, including nested spans'),
+            ('bytes', 'bytes_total', 'Bytes downloaded'),
+            ('requests', 'requests_total', 'HTTP requests sent'),
+            ('rows', 'rows_total', 'Rows produced'),
+        ]
+        totals = sorted(self.totals().items())
+
+        lines = []
+        for (key, suffix, description) in metrics:
+            name = '{}_span_{}'.format(PROMETHEUS_PREFIX, suffix)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} counter'.format(name))
+            for (span, t) in totals:
+                lines.append('{}{{span="{}"}} {}'.format(name, span, t[key]))
+
+        _makedirs(path)
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+        print('Metrics written to {}'.format(path))
+
+
+def _makedirs(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+@contextmanager
+def profile(path, top=20):
+    '''
+    Runs the code in a with block under cProfile, then prints the slowest
+    functions and saves the full profile (readable with pstats or snakeviz).
+
+    params:
+    - path: the file the profile is saved to
+    - top: the number of functions printed, by cumulative time
+    '''
+
+    import cProfile, pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        _makedirs(path)
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+        print('Profile written to {}'.format(path))
+
+
+_metrics = Metrics()
+
+
+def configure(**kwargs):
+    '''
+    Replaces the shared metrics with ones built from the given Metrics
+    arguments (enabled, max_spans).
+    '''
+
+    global _metrics
+    _metrics = Metrics(**kwargs)
+    return _metrics
+
+
+def get_metrics():
+    return _metrics
+
+
+def span(name, category='stage'):
+    '''
+    Times a with block in the shared metrics (see Metrics.span).
+    '''
+
+    return _metrics.span(name, category)
+
+
+def measured(name, category='stage'):
+    '''
+    Decorator that runs every call of a function in a span. If the
+    function returns a list, its length is recorded as the span's rows.
+    '''
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _metrics.span(name, category) as span:
+                result = func(*args, **kwargs)
+                if isinstance(result, list):
+                    span.rows = len(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def bind(func):
+    '''
+    Attaches a function to the calling thread's open spans
+    in the shared metrics (see Metrics.bind).
+    '''
+
+    return _metrics.bind(func)
+
+
+def add(bytes=0, requests=0):
+    '''
+    Adds to the open spans of the calling thread in the shared metrics.
+    '''
+
+    _metrics.add(bytes, requests)
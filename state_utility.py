@@ -0,0 +1,164 @@
+'''
+Local SQLite store of the assignments already on Trello.
+
+Each Trello card that holds an assignment is stored by card ID along with
+its list, class, and title, so a run only has to download what changed on
+the board since the last one (see trello_utility.get_assignments).
+'''
+
+from threading import Lock
+from assignment_utility import Assignment
+import sqlite3, os
+
+
+STORE_PATH = os.path.join('.cache', 'assignments.db')
+
+
+class AssignmentStore:
+    '''
+    Assignments synced from Trello plus the cursor (timestamp of the last
+    board action seen) that the next sync should start from.
+    '''
+
+    def __init__(self, path=STORE_PATH):
+        '''
+        params:
+        - path: the SQLite database file; created if it doesn't exist
+        '''
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # the store is shared with the collection threads in main
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS cards (
+                id TEXT PRIMARY KEY,
+                list_id TEXT NOT NULL,
+                class TEXT NOT NULL,
+                title TEXT NOT NULL,
+                due TEXT NOT NULL,
+                description TEXT NOT NULL,
+                class_key TEXT NOT NULL,
+                title_key TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cards_key ON cards (class_key, title_key);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+
+    def close(self):
+        self._db.close()
+
+    def _get_meta(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (key, value))
+
+    @property
+    def cursor(self):
+        '''
+        The date of the newest Trello action already synced,
+        or None if the store has never been synced.
+        '''
+
+        return self._get_meta('since')
+
+    @cursor.setter
+    def cursor(self, value):
+        self._set_meta('since', value)
+
+    @property
+    def scope(self):
+        '''
+        The (board ID, sorted list IDs) tuple the store was last fully
+        synced for, or None. Cards of other boards or lists aren't in the
+        store, so a different scope needs a full sync.
+        '''
+
+        board_id = self._get_meta('board-id')
+        if board_id is None:
+            return None
+        lists = self._get_meta('lists')
+        return (board_id, lists.split(',') if lists else [])
+
+    @scope.setter
+    def scope(self, value):
+        board_id, list_ids = value
+        self._set_meta('board-id', board_id)
+        self._set_meta('lists', ','.join(sorted(list_ids)))
+
+    def clear(self):
+        '''
+        Forgets every card and the sync cursor, forcing a full sync.
+        '''
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM cards')
+            self._db.execute('DELETE FROM meta')
+
+    def put(self, card_id, list_id, assignment):
+        '''
+        Adds or replaces the assignment held by a Trello card.
+
+        params:
+        - card_id: the ID of the Trello card
+        - list_id: the ID of the list the card is in
+        - assignment: the Assignment parsed from the card
+        '''
+
+        class_key, title_key = assignment.key
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (card_id, list_id, assignment.class_name, assignment.title,
+                assignment.due, assignment.description,
+                class_key, title_key))
+
+    def remove(self, card_id):
+        '''
+        Forgets a Trello card (deleted, archived, or no longer an assignment).
+        '''
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM cards WHERE id = ?', (card_id,))
+
+    def __contains__(self, assignment):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT 1 FROM cards WHERE class_key = ? AND title_key = ?',
+                assignment.key).fetchone()
+        return row is not None
+
+    def assignments(self, list_ids=None):
+        '''
+        Returns the stored assignments.
+
+        params:
+        - list_ids: only return cards in these Trello lists;
+          if None, cards from every list are returned
+
+        returns:
+        - a list of Assignments
+        '''
+
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT list_id, class, title, due, description FROM cards'
+            ).fetchall()
+
+        return [
+            Assignment(c, t, d, description=desc)
+            for (list_id, c, t, d, desc) in rows
+            if list_ids is None or list_id in list_ids]
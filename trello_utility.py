@@ -1,5 +1,51 @@
 # https://developer.atlassian.com/cloud/trello/rest/
-import requests, re, json, sys, os.path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timezone
+from threading import Lock
+from assignment_utility import Assignment
+from http_utility import TokenBucket
+import config_utility, http_utility, metrics_utility, re, json, os, sys, time
+
+
+API_URL = 'https://api.trello.com/1'
+
+# board actions that can add, change, or remove an assignment card
+CARD_ACTIONS = ','.join([
+    'createCard', 'copyCard', 'updateCard', 'deleteCard',
+    'moveCardToBoard', 'moveCardFromBoard', 'convertToCardFromCheckItem',
+    'addLabelToCard', 'removeLabelFromCard'])
+
+# most actions Trello returns per request
+ACTIONS_LIMIT = 1000
+
+# card fields needed to make an Assignment; the description is left out
+# when the assignments are only used to find new ones
+CARD_FIELDS = 'name,due,idList,labels'
+
+# default number of cards created at once
+UPLOAD_WORKERS = 4
+
+# times a card creation is retried after Trello answers 429
+MAX_RETRIES = 5
+
+# board labels cache, kept next to trello-info.json
+BOARD_CACHE_FILE = 'trello-cache.json'
+BOARD_CACHE_TTL = 24 * 60 * 60
+
+# colors given to labels created for new classes, picked by class name
+LABEL_COLORS = ['green', 'yellow', 'orange', 'red', 'purple',
+    'blue', 'sky', 'lime', 'pink']
+
+
+class UnknownLabelError(Exception):
+    '''
+    Trello refused a card because of a label that isn't on the board
+    (e.g. it was deleted since the labels were cached).
+    '''
+
+
+# Trello allows 100 requests per 10 seconds per token
+RATE_LIMITER = TokenBucket(rate=9, capacity=10)
 
 
 def load_credentials(path='credentials.json'):
@@ -15,30 +61,11 @@ def load_credentials(path='credentials.json'):
     - a Python dictionary with Trello API key, token
     '''
 
-    # try to get file path from arguments
-    if len(sys.argv) > 1:
-        pattern = re.compile(path)
-        for arg in sys.argv[1:]:
-            if pattern.search(arg):
-                path = arg
-
-    # try to load credentials from local JSON file
-    if os.path.exists(path):
-        try:
-            f = open(path)
-            data = json.load(f)
-            key = data['trello']['key']
-            token = data['trello']['token']
-            print('Credentials loaded from {}'.format(path))
-            return {'key': key, 'token': token}
-
-        except Exception as e:
-            print('Fatal error: '.format(e))
-            sys.exit(1)
-
-    # file did not exist
-    else:
-        print('Fatal error: file {} does not exist'.format(path))
+    data = config_utility.load_json(path, 'Credentials')
+    try:
+        return {'key': data['trello']['key'], 'token': data['trello']['token']}
+    except Exception as e:
+        print('Fatal error loading Trello credentials: {}'.format(e))
         sys.exit(1)
 
 
@@ -56,44 +83,23 @@ def load_board_info(path='trello-info.json'):
     - a tuple with trello board ID, trello lists
     '''
 
-    # try to get file path from arguments
-    if len(sys.argv) > 1:
-        pattern = re.compile(path)
-        for arg in sys.argv[1:]:
-            if pattern.search(arg):
-                path = arg
-
-    # load data from file if it exists
-    if os.path.exists(path):
-        try:
-            f = open(path)
-            data = json.load(f)
-            board_id = data['board-id']
-            lists = data['lists']
-            print('Trello info loaded from {}'.format(path))
-            return (board_id, lists)
-
-        # I/O error of some kind
-        except Exception as e:
-            print('Fatal error: '.format(e))
-            sys.exit(1)
-
-    # file did not exist
-    else:
-        print('Fatal error: file {} does not exist'.format(path))
+    data = config_utility.load_json(path, 'Trello info')
+    try:
+        return (data['board-id'], data['lists'])
+    except Exception as e:
+        print('Fatal error loading Trello info: {}'.format(e))
         sys.exit(1)
 
 
-def _trello_card_to_dict(card):
+def trello_card_to_assignment(card):
     '''
-    Converts a Trello card (received from HTTPS request) to a Python dict.
+    Converts a Trello card (received from HTTPS request) to an Assignment.
 
     params:
     - card: the Trello card received from REST request
 
     returns:
-    - Python dict with keys class, title, due, and description,
-      or None if the Trello card didn't have all those fields
+    - an Assignment, or None if the Trello card didn't have a due date
     '''
 
     result = None
@@ -102,13 +108,8 @@ def _trello_card_to_dict(card):
     if 'due' in card.keys() and card['due']:
         due = re.sub(r'\w$', '', card['due'])
 
-        # return dictionary
-        result = {
-            'class': card['labels'][0]['name'],
-            'title': card['name'],
-            'due': due,
-            'description': card['desc']
-        }
+        result = Assignment(card['labels'][0]['name'], card['name'], due,
+            description=card.get('desc', ''))
 
     # this Trello card didn't have a due date
     else:
@@ -118,6 +119,7 @@ def _trello_card_to_dict(card):
     return result
 
 
+@metrics_utility.measured('trello.labels', 'http')
 def _get_trello_labels(query, board_id):
     '''
     Gets the labels on the Trello board specified in program constants.
@@ -130,9 +132,9 @@ def _get_trello_labels(query, board_id):
     - a list of Trello labels (class names)
     '''
 
-    labels_json = json.loads(requests.request(
+    labels_json = json.loads(http_utility.request(
         'GET',
-        f'https://api.trello.com/1/boards/{board_id}/labels',
+        f'{API_URL}/boards/{board_id}/labels',
         params=query
     ).text)
     labels = {}
@@ -141,89 +143,779 @@ def _get_trello_labels(query, board_id):
     return labels
 
 
-def get_assignments(query, trello_lists):
+@metrics_utility.measured('trello.create_label', 'http')
+def _create_label(query, board_id, name):
     '''
-    Returns a Python object of all the card in the specified lists.
+    Creates a label on a Trello board.
+
+    returns:
+    - the ID of the new label
+
+    raises:
+    - requests.HTTPError if Trello refused to create the label
+    '''
+
+    RATE_LIMITER.take()
+    response = http_utility.request(
+        'POST',
+        API_URL + '/labels',
+        params={**query, 'idBoard': board_id, 'name': name,
+            'color': LABEL_COLORS[sum(map(ord, name)) % len(LABEL_COLORS)]}
+    )
+    response.raise_for_status()
+    return json.loads(response.text)['id']
+
+
+class BoardCache:
+    '''
+    The labels (class names) of a Trello board, kept in a JSON file for up
+    to a TTL so uploads don't have to fetch them every time.
+    '''
+
+    def __init__(self, path=None, ttl=BOARD_CACHE_TTL):
+        '''
+        params:
+        - path: the JSON file the cache is kept in; defaults to
+          trello-cache.json next to trello-info.json
+        - ttl: seconds before the cached labels are fetched again
+        '''
+
+        if path is None:
+            path = os.path.join(os.path.dirname(
+                config_utility.find_path('trello-info.json')), BOARD_CACHE_FILE)
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+        self._data = config_utility.load_json_file(path)
+
+    def _fresh(self, board_id):
+        return self._data.get('board-id') == board_id \
+            and time.time() - self._data.get('fetched', 0) < self.ttl
+
+    def _refresh(self, query, board_id):
+        self._data = {
+            'board-id': board_id,
+            'fetched': time.time(),
+            'labels': _get_trello_labels(query, board_id)}
+        self._save()
+
+    def _save(self):
+        config_utility.save_json_file(self.path, self._data, indent=2)
+
+    def labels(self, query, board_id):
+        '''
+        Returns the board's labels, fetching them if the cache has expired.
+
+        returns:
+        - a dictionary of label names to IDs
+        '''
+
+        with self._lock:
+            if not self._fresh(board_id):
+                self._refresh(query, board_id)
+            return dict(self._data['labels'])
+
+    def invalidate(self):
+        '''
+        Forgets the cached labels so the next use fetches them.
+        '''
+
+        with self._lock:
+            self._data = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def create_labels(self, query, board_id, names, max_workers=UPLOAD_WORKERS):
+        '''
+        Creates the labels that aren't on the board yet, all at once.
+
+        params:
+        - query: a dictionary with Trello API key and token
+        - board_id: the ID of the Trello board
+        - names: the label names (class names) that should exist
+        - max_workers: the most labels created at once
+
+        returns:
+        - a dictionary of label names to IDs, including the new labels;
+          labels that couldn't be created are left out
+        '''
+
+        labels = self.labels(query, board_id)
+        missing = sorted(set(names) - labels.keys())
+        if not missing:
+            return labels
+
+        print('Creating Trello labels: {}'.format(', '.join(missing)))
+
+        def create(name):
+            try:
+                return (name, _create_label(query, board_id, name))
+            except Exception as e:
+                print('Error creating label "{}": {}'.format(name, e))
+                return (name, None)
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            created = {name: id for (name, id) in pool.map(create, missing) if id}
+
+        with self._lock:
+            if self._fresh(board_id):
+                self._data['labels'].update(created)
+                self._save()
+        labels.update(created)
+        return labels
+
+
+_board_cache = None
+_board_cache_lock = Lock()
+
+
+def get_board_cache():
+    '''
+    Returns the shared board cache (next to trello-info.json),
+    creating it if needed.
+    '''
+
+    global _board_cache
+    with _board_cache_lock:
+        if _board_cache is None:
+            _board_cache = BoardCache()
+        return _board_cache
+
+
+@metrics_utility.measured('trello.list_cards', 'http')
+def _get_list_cards(query, trello_lists, fields='all'):
+    '''
+    Downloads every card in the specified lists, one request per list.
 
     params:
     - query: a dictionary with Trello API key and token
-    - trello_lists: a list of dictionaries (name, id) of Trello lists
+    - trello_lists: a dictionary of Trello list names to IDs
+    - fields: the comma-separated card fields to download, or 'all'
 
     returns:
-    - a Python object of all the card in a list
+    - a list of Trello cards
     '''
-    
-    url = 'https://api.trello.com/1/lists/{}/cards'
+
+    url = API_URL + '/lists/{}/cards'
 
     cards_json = []
     for (name, id) in trello_lists.items():
-        response = requests.request(
+        response = http_utility.request(
             'GET',
             url.format(id),
-            params=query
+            params={**query, 'fields': fields}
         )
         cards_json.extend(json.loads(response.text))
 
-    # convert to Python dictionaries for easy comparison
-    cards_list = []
+    return cards_json
+
+
+@metrics_utility.measured('trello.board_cards', 'http')
+def _get_board_cards(query, board_id, trello_lists, fields=CARD_FIELDS):
+    '''
+    Downloads the open cards of the whole board in a single request and
+    keeps the ones in the specified lists.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - fields: the comma-separated card fields to download
+
+    returns:
+    - a list of Trello cards with only the requested fields (and ID)
+    '''
+
+    response = http_utility.request(
+        'GET',
+        f'{API_URL}/boards/{board_id}/cards',
+        params=board_cards_params(query, fields)
+    )
+    return listed_cards(response, trello_lists)
+
+
+def board_cards_params(query, fields):
+    '''
+    Returns the query parameters that get the open cards of a board with
+    the requested fields (see _get_board_cards).
+    '''
+
+    return {**query, 'fields': fields, 'filter': 'open'}
+
+
+def listed_cards(response, trello_lists):
+    '''
+    Returns the cards of a board response that are in the specified lists.
+    '''
+
+    list_ids = set(trello_lists.values())
+    return [card for card in json.loads(response.text) if card['idList'] in list_ids]
+
+
+def sync_timestamp():
+    '''
+    Returns the current time as a Trello action date, the cursor of a full
+    sync that starts now (changes made while downloading are picked up by
+    the next sync).
+    '''
+
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds') \
+        .replace('+00:00', 'Z')
+
+
+def store_is_synced(store, board_id, trello_lists):
+    '''
+    Returns whether a store can be synced incrementally; a store synced
+    for another board or other lists is missing cards, so it needs a full
+    sync instead.
+    '''
+
+    return store.cursor is not None \
+        and store.scope == (board_id, sorted(trello_lists.values()))
+
+
+def fill_store(store, board_id, trello_lists, cards, since):
+    '''
+    Replaces the contents of the store with the cards of a full sync.
+
+    params:
+    - store: the AssignmentStore to fill
+    - board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - cards: the JSON cards in the lists
+    - since: the sync_timestamp from before the cards were downloaded
+    '''
+
+    store.clear()
+    for card in cards:
+        assignment = trello_card_to_assignment(card)
+        if assignment:
+            store.put(card['id'], card['idList'], assignment)
+    store.cursor = since
+    store.scope = (board_id, trello_lists.values())
+
+    print('Synced {} Trello cards'.format(len(cards)))
+
+
+def actions_params(query, since):
+    '''
+    Returns the query parameters that get the card actions on a board
+    since a store's cursor.
+    '''
+
+    return {**query, 'filter': CARD_ACTIONS, 'since': since, 'limit': ACTIONS_LIMIT}
+
+
+def changed_card_ids(actions):
+    '''
+    Returns the IDs of the cards that the actions touched, each only once,
+    or None if there were too many actions to apply one at a time and a
+    full sync is needed instead.
+    '''
+
+    if len(actions) >= ACTIONS_LIMIT:
+        return None
+
+    # actions come newest first
+    card_ids = []
+    for action in actions:
+        card = action['data'].get('card')
+        if card and card['id'] not in card_ids:
+            card_ids.append(card['id'])
+    return card_ids
+
+
+def changed_card_params(query, fields):
+    '''
+    Returns the query parameters that get a card touched by an action,
+    including whether it was archived.
+    '''
+
+    return {**query, 'fields': fields + ',closed'}
+
+
+def apply_changed_cards(store, actions, responses):
+    '''
+    Updates the store with the cards that the actions touched and moves
+    its cursor past the actions.
+
+    params:
+    - store: the AssignmentStore to update
+    - actions: the actions since the store's cursor
+    - responses: a (card ID, response) tuple for every changed_card_ids
+    '''
+
+    count = 0
+    for (card_id, response) in responses:
+        # deleted cards 404, archived cards no longer count
+        card = json.loads(response.text) if response.status_code == 200 else None
+        assignment = trello_card_to_assignment(card) \
+            if card and not card['closed'] else None
+        if assignment:
+            store.put(card_id, card['idList'], assignment)
+        else:
+            store.remove(card_id)
+        count += 1
+
+    if actions:
+        store.cursor = actions[0]['date']
+
+    print('Synced {} changed Trello cards'.format(count))
+
+
+@metrics_utility.measured('trello.sync', 'http')
+def _full_sync(query, board_id, trello_lists, store, fields=CARD_FIELDS):
+    '''
+    Replaces the contents of the store with every card in the lists.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - board_id: the ID of the Trello board
+    - trello_lists: a dictionary of Trello list names to IDs
+    - store: the AssignmentStore to fill
+    - fields: the comma-separated card fields to download
+    '''
+
+    since = sync_timestamp()
+    fill_store(store, board_id, trello_lists,
+        _get_board_cards(query, board_id, trello_lists, fields), since)
+
+
+@metrics_utility.measured('trello.sync', 'http')
+def _incremental_sync(query, board_id, store, fields=CARD_FIELDS):
+    '''
+    Applies the board actions since the store's cursor to the store,
+    re-downloading only the cards those actions touched.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - board_id: the ID of the Trello board
+    - store: the AssignmentStore to update
+    - fields: the comma-separated card fields to download
+
+    returns:
+    - False if there were too many actions to apply one at a time
+      and a full sync is needed instead, otherwise True
+    '''
+
+    actions = json.loads(http_utility.request(
+        'GET',
+        f'{API_URL}/boards/{board_id}/actions',
+        params=actions_params(query, store.cursor)
+    ).text)
+    card_ids = changed_card_ids(actions)
+    if card_ids is None:
+        return False
+
+    # the cards are only downloaded as the store is updated
+    apply_changed_cards(store, actions, ((card_id, http_utility.request(
+        'GET',
+        f'{API_URL}/cards/{card_id}',
+        params=changed_card_params(query, fields)
+    )) for card_id in card_ids))
+    return True
+
+
+def get_assignments(query, trello_lists, board_id=None, store=None,
+        include_desc=True):
+    '''
+    Returns a Python object of all the card in the specified lists.
+
+    With a board ID, the board's cards are downloaded in one request with
+    only the fields an Assignment needs. If a store is given too, only the
+    changes to the board since the last run are downloaded and the
+    assignments come from the store.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - trello_lists: a dictionary of Trello list names to IDs
+    - board_id: the ID of the Trello board; required with a store
+    - store: an AssignmentStore to sync incrementally, or None to
+      download every card
+    - include_desc: download card descriptions; without them the
+      assignments are only good for finding new assignments (a store
+      synced without them keeps empty descriptions until a full sync)
+
+    returns:
+    - a list of Assignments for all the cards in the lists
+    '''
+
+    return list(iter_assignments(query, trello_lists, board_id, store, include_desc))
+
+
+def iter_assignments(query, trello_lists, board_id=None, store=None,
+    include_desc=True):
+    '''
+    Yields the assignments of the cards in the specified lists one at a
+    time (see get_assignments), e.g. to build an AssignmentIndex without
+    keeping every Assignment around.
+
+    params:
+    - query, trello_lists, board_id, store, include_desc:
+      see get_assignments
+
+    returns:
+    - a generator of Assignments
+    '''
+
+    fields = CARD_FIELDS + (',desc' if include_desc else '')
+
+    # sync the local store with the board, in full if it must be
+    if store is not None and board_id is not None:
+        if not store_is_synced(store, board_id, trello_lists) \
+        or not _incremental_sync(query, board_id, store, fields):
+            _full_sync(query, board_id, trello_lists, store, fields)
+        yield from store.assignments(set(trello_lists.values()))
+        return
+
+    if board_id is not None:
+        cards_json = _get_board_cards(query, board_id, trello_lists, fields)
+    else:
+        cards_json = _get_list_cards(query, trello_lists, fields)
+
+    # convert to Assignments for easy comparison
     for card in cards_json:
-        card_dict = _trello_card_to_dict(card)
-        if card_dict:
-            cards_list.append(card_dict)
+        assignment = trello_card_to_assignment(card)
+        if assignment:
+            yield assignment
+
 
-    return cards_list
+def card_params(query, assignment, list_id, label_id):
+    '''
+    Builds the query parameters that create a labelled card for an assignment.
+    '''
 
+    return {
+        **query,
+        'idList': list_id,
+        'idLabels': label_id,
+        'name': assignment.title,
+        'desc': assignment.description,
+        'due': assignment.due
+    }
 
-def upload_assignments(query, assignments, board_id, list_id):
+
+@metrics_utility.measured('trello.create_card', 'http')
+def _create_card(query, assignment, list_id, label_id):
     '''
-    Add dictionary of assignments to the specified Trello board.
+    Creates a labelled Trello card for an assignment in a single request,
+    waiting out Trello's rate limit when it is hit.
 
     params:
     - query: a dictionary with Trello API key and token
-    - assignments: a dictionary of new school assignments
+    - assignment: the Assignment to add
+    - list_id: the ID of the Trello list to add the card to
+    - label_id: the ID of the assignment's class label
+
+    returns:
+    - the ID of the new card
+
+    raises:
+    - UnknownLabelError if Trello refused the label
+    - requests.HTTPError if Trello refused to create the card otherwise
+    '''
+
+    params = card_params(query, assignment, list_id, label_id)
+
+    for attempt in range(MAX_RETRIES + 1):
+        RATE_LIMITER.take()
+        response = http_utility.request(
+            'POST',
+            API_URL + '/cards',
+            params=params
+        )
+
+        card_id = created_card_id(response, attempt)
+        if card_id is not None:
+            return card_id
+        time.sleep(http_utility.retry_delay(response, attempt))
+
+
+def created_card_id(response, attempt):
+    '''
+    Reads Trello's answer to an attempt at creating a card; shared by the
+    threaded and async uploaders.
+
+    params:
+    - response: the response to POST /cards
+    - attempt: the number of the attempt, from 0
+
+    returns:
+    - the ID of the new card, or None if Trello rate limited the attempt
+      and it should be sent again after http_utility.retry_delay
+
+    raises:
+    - UnknownLabelError if Trello refused the label
+    - requests.HTTPError if Trello refused to create the card otherwise
+    '''
+
+    # rate limited; wait as long as Trello asks before trying again
+    if response.status_code == 429 and attempt < MAX_RETRIES:
+        return None
+
+    # e.g. "invalid value for idLabels" for a deleted label
+    if 400 <= response.status_code < 500 \
+    and 'label' in response.text.lower():
+        raise UnknownLabelError(response.text)
+
+    response.raise_for_status()
+    return json.loads(response.text)['id']
+
+
+def card_report(a, card_id=None, error=None):
+    '''
+    Prints how adding an assignment went and returns its report
+    (see upload_assignments); shared by the threaded and async uploaders.
+
+    params:
+    - a: the Assignment
+    - card_id: the ID of its new card, if it was created
+    - error: the exception that stopped it otherwise;
+      if neither is given, its class has no Trello label
+    '''
+
+    report = {'class': a.class_name, 'title': a.title,
+        'status': 'created', 'card_id': card_id, 'error': None}
+
+    if card_id is not None:
+        print("Added {}".format(a.title))
+
+    # ignore assignment if class not listed in Trello labels
+    elif error is None or isinstance(error, UnknownLabelError):
+        if error is None:
+            print('Error adding "{}": no Trello label "{}"'\
+                .format(a.title, a.class_name))
+        else:
+            print('Error adding "{}": Trello label "{}" no longer exists'\
+                .format(a.title, a.class_name))
+        report['status'] = 'skipped'
+        report['error'] = 'no Trello label "{}"'.format(a.class_name)
+
+    else:
+        print('Error adding "{}": {}'.format(a.title, error))
+        report['status'] = 'failed'
+        report['error'] = str(error)
+
+    return report
+
+
+class CardUploader:
+    '''
+    Creates the cards of assignments from any number of threads, sharing
+    the board's labels. If Trello refuses a cached label, the labels are
+    fetched again (only by the first card to hit it) and the card is
+    retried once; a class missing from the cached labels fetches them
+    again once per upload. The async uploader shares its labels too,
+    calling add_labels, missing_label and refresh_label from worker
+    threads.
+    '''
+
+    def __init__(self, query, board_id, list_id, board_cache, labels):
+        '''
+        params:
+        - query: a dictionary with Trello API key and token
+        - board_id: the Trello board the labels are on
+        - list_id: the ID of the Trello list to add cards to
+        - board_cache: the BoardCache the labels come from
+        - labels: the current dictionary of label names to IDs
+        '''
+
+        self.query = query
+        self.board_id = board_id
+        self.list_id = list_id
+        self.board_cache = board_cache
+
+        # replaced as a whole when the labels are fetched again
+        self._labels = labels
+        self._created = set()
+        self._refreshed = False
+        self._lock = Lock()
+
+    def add_labels(self, names):
+        '''
+        Creates the labels of classes that don't have one yet; each name
+        is only tried once.
+        '''
+
+        with self._lock:
+            names = set(names) - self._labels.keys() - self._created
+            if names:
+                self._created |= names
+                self._labels = self.board_cache.create_labels(
+                    self.query, self.board_id, names)
+
+    def label(self, name):
+        '''
+        Returns the ID of a class's label, or None if it has none.
+        '''
+
+        return self._labels.get(name)
+
+    def missing_label(self, name):
+        '''
+        Fetches the labels again for a class the cached labels don't have,
+        in case its label was added since they were cached; this happens
+        at most once per upload.
+
+        returns:
+        - the ID of the label, or None if it still has none
+        '''
+
+        with self._lock:
+            if name not in self._labels and not self._refreshed:
+                self._refreshed = True
+                self.board_cache.invalidate()
+                self._labels = self.board_cache.labels(self.query, self.board_id)
+            return self._labels.get(name)
+
+    def refresh_label(self, name, stale_id):
+        '''
+        Fetches the labels again after Trello refused stale_id, unless
+        another card already did.
+
+        returns:
+        - the current ID of the label, or None if it no longer exists
+        '''
+
+        with self._lock:
+            if self._labels.get(name) == stale_id:
+                self.board_cache.invalidate()
+                self._labels = self.board_cache.labels(self.query, self.board_id)
+            return self._labels.get(name)
+
+    def _create(self, a, label_id):
+        try:
+            return _create_card(self.query, a, self.list_id, label_id)
+        except UnknownLabelError:
+            label_id = self.refresh_label(a.class_name, label_id)
+            if label_id is None:
+                raise
+            return _create_card(self.query, a, self.list_id, label_id)
+
+    def upload(self, a):
+        '''
+        Creates the card of an assignment; one card failing does not stop
+        the rest.
+
+        returns:
+        - a report dictionary (see upload_assignments)
+        '''
+
+        label_id = self.label(a.class_name)
+        if label_id is None:
+            label_id = self.missing_label(a.class_name)
+        if label_id is None:
+            return card_report(a)
+
+        try:
+            return card_report(a, self._create(a, label_id))
+        except Exception as e:
+            return card_report(a, error=e)
+
+
+def upload_assignments(query, assignments, board_id, list_id,
+    max_workers=UPLOAD_WORKERS, board_cache=None, create_labels=None):
+    '''
+    Add a list of assignments to the specified Trello board.
+    Cards are created concurrently; one card failing does not stop the rest.
+    If Trello refuses a cached label, the labels are fetched again and the
+    card is retried once.
+
+    params:
+    - query: a dictionary with Trello API key and token
+    - assignments: a list of new school Assignments
     - board_id: the Trello board from which to get labels
     - list_id: the ID of the Trello list to add new assignments to
+    - max_workers: the most cards created at once
+    - board_cache: the BoardCache the labels come from;
+      defaults to the shared one (see get_board_cache)
+    - create_labels: whether to create the labels of new classes (all at
+      once, before any card) instead of skipping their assignments;
+      if None, labels are created if --create-labels is in program args
 
     returns:
-    - None
+    - a list with a report for each assignment, in order; each report is a
+      dictionary with the keys class, title, status ("created", "skipped"
+      for a missing label, or "failed"), card_id and error
     '''
 
-    trello_labels = _get_trello_labels(query, board_id)
+    if board_cache is None:
+        board_cache = get_board_cache()
+    if create_labels is None:
+        create_labels = '--create-labels' in sys.argv[1:]
+
+    uploader = CardUploader(query, board_id, list_id, board_cache,
+        board_cache.labels(query, board_id))
+    if create_labels:
+        uploader.add_labels({a.class_name for a in assignments})
 
     print('Adding {} new assignments to Trello'.format(len(assignments)))
 
-    count = 0
-    for a in assignments:
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        reports = list(pool.map(metrics_utility.bind(uploader.upload), assignments))
 
-        # ignore assignment if class not listed in Trello labels
-        if not a['class'] in trello_labels.keys():
-            print('Error adding "{}": no Trello label "{}"'\
-                .format(a['title'], a['class']))
+    count = sum(1 for r in reports if r['status'] == 'created')
+    print('{} assignments added\n'.format(count))
 
-        # go ahead and add assignment
-        else:
-            url = 'https://api.trello.com/1/cards?' \
-                + 'idList={}&name={}&desc={}&due={}'\
-                .format(list_id, a['title'], a['description'], a['due'])
-
-            # add the Trello card
-            response = requests.request(
-                'POST',
-                url,
-                params=query
-            )
-            print("Added {}".format(a['title']))
-
-            # add label
-            card_id = json.loads(response.text)['id']
-            url = 'https://api.trello.com/1/cards/{}/idLabels?value={}'\
-                .format(card_id, trello_labels[a['class']])
-            requests.request(
-                'POST',
-                url,
-                params=query
-            )
-
-            count += 1
-
-    print('{} assignments added\n'.format(count))
\ No newline at end of file
+    return reports
+
+
+def upload_stream(query, assignments, board_id, list_id,
+    max_workers=UPLOAD_WORKERS, board_cache=None, create_labels=None):
+    '''
+    Adds assignments to the specified Trello board as they arrive from any
+    iterable (e.g. a generator fed by the sources), like upload_assignments.
+    Each card is started as soon as its assignment arrives, and at most
+    twice max_workers cards wait at once, so a source that is faster than
+    Trello is slowed down instead of piling up assignments.
+
+    params:
+    - query, board_id, list_id, max_workers, board_cache:
+      see upload_assignments
+    - assignments: an iterable of new school Assignments
+    - create_labels: whether to create the label of a new class when its
+      first assignment arrives instead of skipping its assignments;
+      if None, labels are created if --create-labels is in program args
+
+    returns:
+    - a generator of (assignment, report) tuples in the order the cards
+      are done (see upload_assignments for the report)
+    '''
+
+    if board_cache is None:
+        board_cache = get_board_cache()
+    if create_labels is None:
+        create_labels = '--create-labels' in sys.argv[1:]
+
+    max_workers = max(1, max_workers)
+
+    # the labels are only fetched once there is something to upload
+    uploader = None
+    count = 0
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for a in assignments:
+            if uploader is None:
+                uploader = CardUploader(query, board_id, list_id, board_cache,
+                    board_cache.labels(query, board_id))
+                upload = metrics_utility.bind(uploader.upload)
+            if create_labels:
+                uploader.add_labels({a.class_name})
+            pending[pool.submit(upload, a)] = a
+
+            # hand back the cards that are done, waiting if too many are queued
+            done = {f for f in pending if f.done()}
+            if not done and len(pending) >= 2 * max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                report = future.result()
+                count += report['status'] == 'created'
+                yield (pending.pop(future), report)
+
+        for future in as_completed(pending):
+            report = future.result()
+            count += report['status'] == 'created'
+            yield (pending[future], report)
+
+    if uploader is not None:
+        print('{} assignments added\n'.format(count))